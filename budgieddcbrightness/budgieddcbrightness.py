@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
-# TODO does not work with arrow keys
+import json
+import os
 import re
 import subprocess
+import threading
 import gi
 gi.require_version('Gtk', '3.0')
 gi.require_version('Budgie', '1.0')
@@ -18,12 +20,226 @@ class BudgieDdcBrightness(GObject.Object, Budgie.Plugin):
         return BudgieDdcBrightnessApplet(uuid)
 
 
+def idle_call(callback, *args):
+    # Run callback(*args) once on the GTK main loop
+    def call():
+        callback(*args)
+        return GLib.SOURCE_REMOVE
+    GLib.idle_add(call)
+
+
+class DisplayWorker(threading.Thread):
+    # Runs ddcutil for one display, one command at a time. Only the latest
+    # requested brightness is kept, so however fast the slider moves at most
+    # one setvcp is waiting behind the one that is running.
+
+    def __init__(self, backend, display):
+        threading.Thread.__init__(self, daemon=True)
+        self.backend = backend
+        self.display = display
+        self.condition = threading.Condition()
+        self.value = None
+        self.read = False
+        self.stopped = False
+
+    def request(self, value=None, read=False):
+        with self.condition:
+            if value is not None:
+                self.value = value
+            self.read = self.read or read
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not (self.value is not None or self.read or self.stopped):
+                    self.condition.wait()
+                value, self.value = self.value, None
+                read, self.read = self.read, False
+                stopped = self.stopped
+
+            if stopped:
+                # Display went away, don't leave anyone waiting on it
+                if value is not None:
+                    self.backend.set_done(self.display, value, False)
+                if read:
+                    self.backend.read_done(self.display, None)
+                return
+
+            if value is not None:
+                out = self.backend.ddcutil(
+                    '-d', self.display, 'setvcp', '10', str(value))
+                self.backend.set_done(self.display, value, out is not None)
+
+            if read:
+                # Example:
+                # "VCP 10 C 50 100"
+                out = self.backend.ddcutil(
+                    '-d', self.display, '-t', 'getvcp', '10')
+                try:
+                    _, _, _, value, maximum = out.split()
+                    value = int(value)
+                except (AttributeError, ValueError):
+                    value = None
+                self.backend.read_done(self.display, value)
+
+
+class DdcBackend:
+    # Talks to ddcutil without blocking the panel. Every display has its own
+    # worker thread so they are all read or set at the same time, and the
+    # callbacks are run back on the GTK main loop. The detected displays are
+    # cached so the next session can use them straight away instead of waiting
+    # several seconds for "ddcutil detect".
+
+    cache_file = os.path.join(
+        GLib.get_user_cache_dir(), 'budgieddcbrightness', 'displays.json')
+    timeout = 15
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.workers = {}
+        self.displays = []
+        self.detecting = False
+        self.detect_callbacks = []
+        self.reading = set()
+        self.read_callback = None
+        self.target = None
+        self.setting = set()
+        self.failed = set()
+        self.set_callback = None
+        self.values = {}
+        self.set_displays(self.load_cache())
+
+    def ddcutil(self, *args):
+        # ddcutil's output, or None if it failed
+        try:
+            return subprocess.check_output(
+                ('ddcutil',) + args, encoding='utf8',
+                stderr=subprocess.DEVNULL, timeout=self.timeout)
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    def load_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                return [str(d) for d in json.load(f)['displays']]
+        except (OSError, ValueError, KeyError, TypeError):
+            return []
+
+    def save_cache(self, displays):
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(self.cache_file + '.tmp', 'w') as f:
+                json.dump({'displays': displays}, f)
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+        except OSError:
+            pass
+
+    def set_displays(self, displays):
+        with self.lock:
+            for d in set(self.workers) - set(displays):
+                self.workers.pop(d).stop()
+            for d in displays:
+                if d not in self.workers:
+                    self.workers[d] = DisplayWorker(self, d)
+                    self.workers[d].start()
+            self.displays = list(displays)
+
+    def stop(self):
+        self.set_displays([])
+
+    def detect(self, callback):
+        # Re-run "ddcutil detect" and callback(displays) when it's done
+        with self.lock:
+            self.detect_callbacks.append(callback)
+            if self.detecting:
+                return
+            self.detecting = True
+        threading.Thread(target=self._detect, daemon=True).start()
+
+    def _detect(self):
+        out = self.ddcutil('detect')
+        if out is None:
+            displays = self.displays
+        else:
+            displays = re.findall(r'Display (\d+)', out)
+            self.save_cache(displays)
+            self.set_displays(displays)
+        with self.lock:
+            self.detecting = False
+            callbacks, self.detect_callbacks = self.detect_callbacks, []
+        for callback in callbacks:
+            idle_call(callback, displays)
+
+    def get_brightness(self, callback):
+        # Read all displays at once and callback(brightest), or
+        # callback(None) if none of them could be read
+        with self.lock:
+            self.reading = set(self.displays)
+            self.values = {}
+            self.read_callback = callback
+            workers = list(self.workers.values())
+        if not workers:
+            idle_call(callback, None)
+        for worker in workers:
+            worker.request(read=True)
+
+    def read_done(self, display, value):
+        with self.lock:
+            if display not in self.reading:
+                return
+            self.reading.discard(display)
+            if value is not None:
+                self.values[display] = value
+            if self.reading:
+                return
+            values = list(self.values.values())
+            callback = self.read_callback
+        idle_call(callback, max(values) if values else None)
+
+    def set_brightness(self, value, callback):
+        # Set all displays at once and callback(value, failed displays) when
+        # they are done. Calling this again before then replaces the value
+        # still waiting to be set, so only the latest one is applied.
+        with self.lock:
+            self.target = value
+            self.setting = set(self.displays)
+            self.failed = set()
+            self.set_callback = callback
+            workers = list(self.workers.values())
+        if not workers:
+            idle_call(callback, value, [])
+        for worker in workers:
+            worker.request(value=value)
+
+    def set_done(self, display, value, ok):
+        with self.lock:
+            if value != self.target or display not in self.setting:
+                return
+            self.setting.discard(display)
+            if not ok:
+                self.failed.add(display)
+            if self.setting:
+                return
+            failed = sorted(self.failed)
+            callback = self.set_callback
+        idle_call(callback, value, failed)
+
+
 class BudgieDdcBrightnessApplet(Budgie.Applet):
     def __init__(self, uuid):
         Budgie.Applet.__init__(self)
         self.uuid = uuid
         self.manager = None
-        self.displays = self.detect_displays()
+        self.backend = DdcBackend()
+        self.displays = self.backend.displays
+        self.brightness = None
+        self.updating = False
 
         # Panel Button
         self.box = Gtk.EventBox()
@@ -59,10 +275,14 @@ class BudgieDdcBrightnessApplet(Budgie.Applet):
             self.scale.add_mark(mark, Gtk.PositionType.LEFT, str(mark))
 
         # Connect signals
+        self.scale.connect("value-changed", self.value_changed)
         self.scale.connect("button-release-event", self.button_released)
 
-        self.brightness = self.get_brightness()
-        self.scale.set_value(self.brightness)
+        # Use the displays found last time to show the current brightness
+        # straight away, and check for new ones in the background
+        if self.displays:
+            self.backend.get_brightness(self.brightness_read)
+        self.backend.detect(self.displays_detected)
 
         layout.attach(self.scale, 0, 0, 1, 1)
 
@@ -73,16 +293,33 @@ class BudgieDdcBrightnessApplet(Budgie.Applet):
         self.show_all()
 
         self.box.connect("button-press-event", self._on_press)
+        self.connect("destroy", lambda applet: self.backend.stop())
+
+    def value_changed(self, scale):
+        # Slider dragged or moved with the keyboard, the backend only applies
+        # the latest value so there is no need to wait for the release
+        if not self.updating:
+            self.set_brightness(int(self.scale.get_value()))
 
     def button_released(self, scale, event):
-        brightness = int(self.scale.get_value())
-        self.set_brightness(brightness)
+        self.popover.hide()
         return True
 
-    def detect_displays(self):
-        out = subprocess.check_output(['ddcutil', 'detect'], encoding='utf8')
-        displays = [d for d in re.findall('Display ([1-9])', out)]
-        return displays
+    def displays_detected(self, displays):
+        if not displays:
+            self.box.set_tooltip_text("Screen Brightness\nNo displays found")
+        elif displays != self.displays or self.brightness is None:
+            self.backend.get_brightness(self.brightness_read)
+        self.displays = displays
+
+    def brightness_read(self, value):
+        if value is None:
+            return
+        self.brightness = value
+        self.update_icon(value)
+        self.updating = True
+        self.scale.set_value(value)
+        self.updating = False
 
     def do_supports_settings(self):
         return False
@@ -91,26 +328,19 @@ class BudgieDdcBrightnessApplet(Budgie.Applet):
         manager.register_popover(self.box, self.popover)
         self.manager = manager
 
-    def get_brightness(self):
-        # Example:
-        # "VCP 10 C 50 100"
-        values = []
-        for d in self.displays:
-            _, _, _, value, maximum = subprocess.check_output(
-                ['ddcutil', '-d', d, '-t', 'getvcp', '10'],
-                encoding='utf8').split()
-            values.append(int(value))
-        value = max(values)
-        self.update_icon(value)
-        return value
-
     def set_brightness(self, value):
-        self.popover.hide()
-        for d in self.displays:
-            self.brightness = value
-            self.update_icon(value)
-            args = ['ddcutil', '-d', d, 'setvcp', '10', str(value)]
-            subprocess.call(args)
+        self.brightness = value
+        self.update_icon(value)
+        self.backend.set_brightness(value, self.brightness_set)
+
+    def brightness_set(self, value, failed):
+        if failed:
+            self.box.set_tooltip_text(
+                "Screen Brightness\nCouldn't set display %s" % ", ".join(failed))
+            # The cached displays may be out of date
+            self.backend.detect(self.displays_detected)
+        else:
+            self.box.set_tooltip_text("Screen Brightness")
 
     def update_icon(self, value):
         if value <= 25:
@@ -130,7 +360,9 @@ class BudgieDdcBrightnessApplet(Budgie.Applet):
         # If middle button clicked, set max brightness
         elif e.button == 2:
             self.set_brightness(100)
+            self.updating = True
             self.scale.set_value(100)
+            self.updating = False
             return Gdk.EVENT_STOP
 
         # Show / hide popover
@@ -1,4 +1,4 @@
-"
+"""
 Context manager for "stuff"
 E.g
 
@@ -6,14 +6,35 @@ E.g
 import arcpy
 from env import env
 
-with env(arcy.env, workspace='C:/Temp'):
+with env(arcpy.env, workspace='C:/Temp'):
    do_stuff()
 ```
+
+`env` sets attributes on a shared object, so it isn't safe to use from multiple threads at once.
+`LayeredEnv` keeps overrides in a context variable instead so each thread/task reading attributes through it
+sees its own layers. That doesn't make threaded geoprocessing safe: arcpy tools read the process wide `arcpy.env`,
+which `LayeredEnv.applied()` sets like `env` does. Only `env_pool` isolates tools, it starts a process pool with
+the active overrides applied to each worker's own env object once at start up.
+
+```
+settings = LayeredEnv(arcpy.env)
+with settings(workspace='C:/Temp'):
+    settings.workspace  # 'C:/Temp' in this thread/task only, arcpy.env.workspace is unchanged
+    with env_pool('arcpy:env', settings) as pool:  # arcpy.env.workspace = 'C:/Temp' in each worker
+        pool.map(do_stuff, jobs)
+```
 License is Apache 2.0
 """
 
+import contextvars
+import importlib
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 
+# LayeredEnv overrides in the current context, {id(env object): {key: value}}.
+# One module level variable as context variables are never freed.
+_overrides = contextvars.ContextVar('env_overrides', default={})
+
 @contextmanager
 def env(obj, **kwargs):
     """ Temporarily set env var """
@@ -32,3 +53,75 @@ def env(obj, **kwargs):
     finally:
         for key, val in old_env.items():
             setattr(obj, key, val)
+
+
+class LayeredEnv(object):
+    """ Per thread/task view of an env object
+
+        Attributes are read from the overrides layered on in the current context, falling back to obj.
+        New threads start with no layers, use submit() to run a function in a thread pool with the caller's layers.
+        Context variables can't be sent to other processes, use env_pool for process pools.
+        LayeredEnvs of the same obj share layers. obj itself is never changed outside applied(),
+        so code (e.g. arcpy tools) that reads obj directly doesn't see the layers.
+    """
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __getattr__(self, key):
+        overrides = _overrides.get().get(id(self._obj), {})
+        if key in overrides:
+            return overrides[key]
+        return getattr(self._obj, key)
+
+    @contextmanager
+    def __call__(self, **kwargs):
+        """ Temporarily layer env vars on in the current context only """
+        layers = dict(_overrides.get())
+        layers[id(self._obj)] = dict(layers.get(id(self._obj), {}), **kwargs)
+        token = _overrides.set(layers)
+        try:
+            yield self
+        finally:
+            _overrides.reset(token)
+
+    def overrides(self):
+        """ Merged overrides active in the current context """
+        return dict(_overrides.get().get(id(self._obj), {}))
+
+    @contextmanager
+    def applied(self):
+        """ Temporarily set the active overrides on obj itself, for code that only reads obj.
+            Not thread safe as obj is shared by every thread, use in a single threaded worker process.
+        """
+        with env(self._obj, **self.overrides()):
+            yield self._obj
+
+
+def submit(pool, fn, *args, **kwargs):
+    """ Submit fn to a thread pool to run with a copy of the caller's context (and so LayeredEnv layers)
+
+        The context can't be pickled, so process pools aren't supported, use env_pool to start one
+        with the layers applied in each worker.
+    """
+    if isinstance(pool, ProcessPoolExecutor):
+        raise TypeError('submit() needs a thread pool, use env_pool() for process pools')
+    return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def _init_worker(target, overrides):
+    module, attr = target.split(':')
+    obj = getattr(importlib.import_module(module), attr)
+    for key, val in overrides.items():
+        setattr(obj, key, val)
+
+
+def env_pool(target, layered_env=None, max_workers=None, **kwargs):
+    """ ProcessPoolExecutor with env overrides applied to target once in each worker when it starts
+
+        target is the 'module:attribute' path of the env object to import in the worker, e.g. 'arcpy:env'
+        overrides are those active in layered_env (if given) in the calling context, plus kwargs.
+        Values must be picklable.
+    """
+    overrides = dict(layered_env.overrides() if layered_env is not None else {}, **kwargs)
+    return ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(target, overrides))
@@ -1,3 +1,15 @@
+import json
+import os
+import shutil
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+import numpy as np
+import rasterio
+
+from overlapping_windows import overlapping_blocks
+
+
 def intervals_1d(arr1d):
     """
     Calculate min, max and mean inter-fire interval and count of <= 3 year inter-fire intervals
@@ -20,28 +32,263 @@ def intervals_1d(arr1d):
 
     return imin, imax, imean, ile3
 
-def intervals(arr3d):
+#Per pixel running state, see _fold
+STATE_BANDS = ('last', 'imin', 'imax', 'isum', 'count', 'ile3', 'fires')
+
+def _new_state(shape):
+    """
+    Empty running inter-fire interval state
+    """
+    state = {band: np.zeros(shape, dtype=np.int32) for band in STATE_BANDS}
+    state['last'][:] = -1  #index of last year with fire occurrence
+    state['imin'][:] = np.iinfo(np.int32).max
+    return state
+
+def _fold(state, fire, year):
+    """
+    Fold fire occurrence in year (a year index or array of them) into the running state in place
+    """
+    last = state['last']
+    burnt = fire & (last >= 0)  #fire this year and a previous year
+    diffs = year - last
+    np.minimum(state['imin'], diffs, out=state['imin'], where=burnt)
+    np.maximum(state['imax'], diffs, out=state['imax'], where=burnt)
+    np.add(state['isum'], diffs, out=state['isum'], where=burnt)
+    np.add(state['count'], 1, out=state['count'], where=burnt)
+    np.add(state['ile3'], diffs <= 3, out=state['ile3'], where=burnt)
+    np.add(state['fires'], 1, out=state['fires'], where=fire)
+    np.copyto(last, year, where=fire)
+
+def _state_outputs(state, stop, frequency=False, since_last=False):
+    """
+    Min, max and mean inter-fire interval and count of <= 3 year inter-fire intervals from the running state
+    and optionally fire frequency and years since last fire, relative to year index stop - 1
+    """
+    count = state['count']
+    imin = np.where(count > 0, state['imin'], 0)
+    imean = np.divide(state['isum'], count, out=np.zeros(count.shape), where=count > 0)
+
+    retval = [imin, state['imax'], imean, state['ile3']]
+    if frequency:
+        retval.append(state['fires'])
+    if since_last:
+        retval.append(np.where(state['last'] >= 0, stop - 1 - state['last'], -1))
+    return tuple(retval)
+
+def intervals(arr3d, frequency=False, since_last=False):
     """
     Calculate min, max and mean inter-fire interval and count of <= 3 year inter-fire intervals
+
+    Scans the time axis once, keeping the last fire year and running interval statistics for each pixel,
+    so pixels can have any number of fires (including 0 or 1).
+    Optionally also returns fire frequency (no. fires) and years since last fire
+    (relative to the last year in arr3d, -1 if there were no fires)
+    """
+    state = _new_state(arr3d.shape[1:])
+    for year in range(arr3d.shape[0]):
+        _fold(state, arr3d[year] != 0, year)
+
+    return _state_outputs(state, arr3d.shape[0], frequency, since_last)
+
+def _swar_popcount(x):
+    """
+    Count set bits in each uint64 for numpy < 2.0 which doesn't have bitwise_count
+    """
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+_popcount = getattr(np, 'bitwise_count', _swar_popcount)
+
+def pack(arr3d):
+    """
+    Pack a (years, rows, cols) fire stack into a (ceil(years / 64), rows, cols) uint64 bitset
+    bit year % 64 of word year // 64 is set if there was a fire that year
     """
-    
     s = arr3d.shape
-    arr2d = arr3d.reshape((s[0], s[1] * s[2]))
+    bits = np.zeros(((s[0] + 63) // 64,) + s[1:], dtype=np.uint64)
+    for year in range(s[0]):
+        bits[year // 64] |= (arr3d[year] != 0).astype(np.uint64) << np.uint64(year % 64)
+    return bits
 
-    #indices of years with fire occurrence
-    ivals = arr2d.nonzero()[0]
-    ivals.shape = (ivals.shape[0] // (s[1] * s[2]), s[1] * s[2])
+def unpack(bits, years):
+    """
+    Unpack a bitset from pack into a (years, rows, cols) uint8 fire stack
+    """
+    arr3d = np.empty((years,) + bits.shape[1:], dtype=np.uint8)
+    for year in range(years):
+        arr3d[year] = (bits[year // 64] >> np.uint64(year % 64)) & np.uint64(1)
+    return arr3d
 
-    #shift & subtract indices to derive intervals
-    diffs=ivals[1:] - ivals[:-1]
+def pack_rasters(fire_rasters, window=None):
+    """
+    Pack a list of yearly fire rasters (in year order) or a single multiband raster (one band per year)
+    reading one year at a time, returns the bitset and number of years
+    """
+    if isinstance(fire_rasters, (str, os.PathLike)):
+        fire_rasters = [fire_rasters]
+
+    bits, year = None, 0
+    for raster in fire_rasters:
+        with rasterio.open(raster) as ds:
+            if bits is None:
+                shape = (window.height, window.width) if window is not None else ds.shape
+                bits = np.zeros((0,) + shape, dtype=np.uint64)
+            for band in range(1, ds.count + 1):
+                if year % 64 == 0:
+                    bits = np.concatenate([bits, np.zeros((1,) + bits.shape[1:], dtype=np.uint64)])
+                fire = ds.read(band, window=window, masked=True).filled(0) != 0
+                bits[year // 64] |= fire.astype(np.uint64) << np.uint64(year % 64)
+                year += 1
+    return bits, year
+
+def bit_intervals(bits, years, start=0, stop=None, frequency=False, since_last=False):
+    """
+    Calculate min, max and mean inter-fire interval and count of <= 3 year inter-fire intervals
+    directly from a bitset from pack for years start to stop (exclusive)
+
+    Fire years are found by repeatedly isolating the lowest set bit of each word, so the work
+    depends on the number of fires not years. Optional outputs are as for intervals,
+    with years since last fire relative to stop - 1
+    """
+    stop = years if stop is None else min(stop, years)
+    state = _new_state(bits.shape[1:])
+
+    for word in range(start // 64, (stop + 63) // 64):
+        lo, hi = max(start - word * 64, 0), min(stop - word * 64, 64)
+        mask = np.uint64(((1 << hi) - 1) ^ ((1 << lo) - 1))
+        x = bits[word] & mask
+
+        while True:
+            fire = x != 0
+            if not fire.any():
+                break
+            lowest = x & (~x + np.uint64(1))
+            x ^= lowest
+            _fold(state, fire, word * 64 + _popcount(lowest - np.uint64(1)).astype(np.int32))
+
+    return _state_outputs(state, stop, frequency, since_last)
+
+def _read_window(datasets, window):
+    """
+    Read a (years, rows, cols) window from a list of yearly rasters or a multiband raster, nodata = no fire
+    """
+    return np.concatenate([ds.read(window=window, masked=True).filled(0) for ds in datasets])
+
+def _window_intervals(arr3d, frequency=False, since_last=False):
+    """
+    Calculate the inter-fire interval statistics for a window, returns a (bands, rows, cols) array
+    """
+    return np.stack(intervals(arr3d, frequency, since_last)).astype(np.float32)
+
+def intervals_raster(fire_rasters, out_raster, workers=None, processes=False, blocksize=256,
+                     frequency=False, since_last=False):
+    """
+    Calculate min, max and mean inter-fire interval and count of <= 3 year inter-fire intervals
+    from a list of yearly fire rasters (in year order) or a single multiband raster (one band per year)
+
+    Windows are read one at a time, processed in a thread (or process if processes=True) pool
+    and written to a 4 band (min, max, mean, <=3 count) GeoTIFF as they finish,
+    with at most 2 * workers windows in memory at once. blocksize must be a multiple of 16.
+    frequency and since_last add fire frequency and years since last fire bands.
+    """
+    if isinstance(fire_rasters, (str, os.PathLike)):
+        fire_rasters = [fire_rasters]
+    workers = workers or os.cpu_count()
+
+    with ExitStack() as stack:
+        datasets = [stack.enter_context(rasterio.open(r)) for r in fire_rasters]
+        profile = datasets[0].profile
+        profile.update(driver='GTiff', count=4 + frequency + since_last, dtype='float32', nodata=None,
+                       tiled=True, blockxsize=blocksize, blockysize=blocksize)
+        dst = stack.enter_context(rasterio.open(out_raster, 'w', **profile))
+        pool = stack.enter_context((ProcessPoolExecutor if processes else ThreadPoolExecutor)(workers))
+
+        pending = {}
+        for window in overlapping_blocks(dst):
+            arr3d = _read_window(datasets, window)
+            pending[pool.submit(_window_intervals, arr3d, frequency, since_last)] = window
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dst.write(future.result(), window=pending.pop(future))
+
+        for future in as_completed(pending):
+            dst.write(future.result(), window=pending[future])
+
+def init_state(state_raster, template_raster, fire_rasters=(), blocksize=256):
+    """
+    Create a running inter-fire interval state GeoTIFF with the same grid as template_raster,
+    one int32 band per STATE_BANDS, then fold in any fire_rasters with update_state.
+    """
+    with rasterio.open(template_raster) as src:
+        profile = src.profile
+    profile.update(driver='GTiff', count=len(STATE_BANDS), dtype='int32', nodata=None,
+                   tiled=True, blockxsize=blocksize, blockysize=blocksize)
+
+    with rasterio.open(state_raster, 'w', **profile) as dst:
+        dst.descriptions = STATE_BANDS
+        dst.update_tags(years=0, sources='[]')
+        for window in overlapping_blocks(dst):
+            state = _new_state((window.height, window.width))
+            dst.write(np.stack([state[band] for band in STATE_BANDS]), window=window)
+
+    if isinstance(fire_rasters, (str, os.PathLike)):
+        fire_rasters = [fire_rasters]
+    for fire_raster in fire_rasters:
+        update_state(state_raster, fire_raster)
+
+def update_state(state_raster, fire_raster):
+    """
+    Fold a new year (or each band of a multiband raster, in year order) of fire occurrence into
+    the state GeoTIFF a window at a time, without re-reading earlier years.
+
+    The update is made to a copy which then replaces the state, so a failed run leaves the state
+    as it was. Folded fire rasters are recorded in the "sources" tag and can't be folded again,
+    and fire_raster must be on the same grid as the state.
+    """
+    source = os.path.abspath(fire_raster)
+    with rasterio.open(state_raster) as dst, rasterio.open(fire_raster) as src:
+        sources = json.loads(dst.tags().get('sources', '[]'))
+        if source in sources:
+            raise ValueError('{} has already been folded into {}'.format(fire_raster, state_raster))
+        if src.shape != dst.shape or src.transform != dst.transform:
+            raise ValueError('{} is not on the same grid as {}'.format(fire_raster, state_raster))
+
+    tmp_raster = state_raster + '.tmp'
+    shutil.copyfile(state_raster, tmp_raster)
     try:
-        imin=diffs.min(axis=0)       #Min inter-fire interval
-        imax=diffs.max(axis=0)       #Max inter-fire interval
-        imean=diffs.mean(axis=0)     #Mean inter-fire interval
-        ile3=(diffs<=3).sum(axis=0)  #No. fires with <= 3 year inter-fire interval
-        imin.shape = imax.shape = ile3.shape=s[1:]
+        with rasterio.open(tmp_raster, 'r+') as dst, rasterio.open(fire_raster) as src:
+            years = int(dst.tags()['years'])
+            for window in overlapping_blocks(dst):
+                state = dict(zip(STATE_BANDS, dst.read(window=window)))
+                fires = src.read(window=window, masked=True).filled(0)
+                for year, fire in enumerate(fires, years):
+                    _fold(state, fire != 0, year)
+                dst.write(np.stack([state[band] for band in STATE_BANDS]), window=window)
+            dst.update_tags(years=years + src.count, sources=json.dumps(sources + [source]))
+        os.replace(tmp_raster, state_raster)
+    except BaseException:
+        os.remove(tmp_raster)
+        raise
 
-    except ValueError: #diffs == array([])
-        imin=imax=imean=ile3=np.zeros(shape=s[1:])
+def state_intervals(state_raster, out_raster, frequency=False, since_last=False):
+    """
+    Write the min, max, mean and <=3 count (plus optional frequency and years since last fire) bands
+    from a state GeoTIFF to out_raster, as intervals_raster would from the full fire history.
+    """
+    with rasterio.open(state_raster) as src:
+        years = int(src.tags()['years'])
+        profile = src.profile
+        profile.update(count=4 + frequency + since_last, dtype='float32')
 
-    return imin, imax, imean, ile3
+        with rasterio.open(out_raster, 'w', **profile) as dst:
+            for window in overlapping_blocks(src):
+                state = dict(zip(STATE_BANDS, src.read(window=window)))
+                outputs = _state_outputs(state, years, frequency, since_last)
+                dst.write(np.stack(outputs).astype(np.float32), window=window)
+
+if __name__ == '__main__':
+    import sys
+    intervals_raster(sys.argv[2:], sys.argv[1])  #Expects sys.argv[1:] == out_raster, fire_raster [fire_raster ...]
@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from itertools import product
+import numpy as np
 import rasterio as rio
 from rasterio import windows
 
@@ -54,3 +58,146 @@ def overlapping_blocks(src, overlap=0, band=1, boundless=False):
                 yield window
             else:
                 yield window.intersection(big_window)
+
+
+def _core_windows(src, width=None, height=None, band=1):
+    """ Non overlapping windows, width x height tiles or src blocks if width/height are None """
+    if width is None or height is None:
+        for ji, window in src.block_windows(band):
+            yield window
+    else:
+        big_window = windows.Window(col_off=0, row_off=0, width=src.meta['width'], height=src.meta['height'])
+        for col_off, row_off in product(range(0, src.meta['width'], width), range(0, src.meta['height'], height)):
+            yield windows.Window(col_off=col_off, row_off=row_off, width=width, height=height).intersection(big_window)
+
+
+def _cached_reads(src, overlap=0, width=None, height=None, stats=None):
+    """ Yield (core window, overlapping window, array) in raster (row major) order, see cached_windows """
+    big_window = windows.Window(col_off=0, row_off=0, width=src.meta['width'], height=src.meta['height'])
+    strip_height, block_width = src.block_shapes[0]
+    width, height = width or block_width, height or strip_height
+    if stats is None:
+        stats = {}
+    for key in ('hits', 'misses', 'bytes_read', 'bytes_yielded'):
+        stats.setdefault(key, 0)
+
+    cache = {}  # Full width strips of src block rows, by block row
+    for row_off in range(0, big_window.height, height):
+        top = max(row_off - overlap, 0)
+        bottom = min(row_off + height + overlap, big_window.height)
+        first, last = top // strip_height, (bottom - 1) // strip_height
+
+        for strip in [strip for strip in cache if strip < first]:
+            del cache[strip]
+        for strip in range(first, last + 1):
+            if strip in cache:
+                stats['hits'] += 1
+            else:
+                strip_window = windows.Window(
+                    col_off=0,
+                    row_off=strip * strip_height,
+                    width=big_window.width,
+                    height=min(strip_height, big_window.height - strip * strip_height))
+                cache[strip] = src.read(window=strip_window)
+                stats['misses'] += 1
+                stats['bytes_read'] += cache[strip].nbytes
+
+        rows = np.concatenate([cache[strip] for strip in range(first, last + 1)], axis=1)
+        rows = rows[:, top - first * strip_height:bottom - first * strip_height]
+
+        for col_off in range(0, big_window.width, width):
+            core = windows.Window(col_off=col_off, row_off=row_off, width=width, height=height).intersection(big_window)
+            window = windows.Window(
+                col_off=col_off - overlap,
+                row_off=row_off - overlap,
+                width=width + overlap * 2,
+                height=height + overlap * 2).intersection(big_window)
+            # A copy, windows share halo columns of rows so a caller modifying arr would corrupt its neighbours
+            arr = rows[:, :, window.col_off:window.col_off + window.width].copy()
+            stats['bytes_yielded'] += arr.nbytes
+            yield core, window, arr
+
+
+def cached_windows(src, overlap=0, width=None, height=None, stats=None):
+    """ Yield (window, array) for overlapping windows in raster (row major) order
+
+        Windows are width x height tiles (src blocks if None) plus overlap pixels either side, clipped to the raster.
+        Full width strips of src block rows are read once and kept until no later window needs them,
+        so each src block is only read (and decompressed) once, instead of again for each neighbouring halo.
+        Each array is a copy of the strips so it can be modified in place, as with src.read().
+        If stats is a dict, it is updated with strip cache 'hits', 'misses', 'bytes_read' and 'bytes_yielded'.
+    """
+    for core, window, arr in _cached_reads(src, overlap, width, height, stats):
+        yield window, arr
+
+
+def process_windows(src, dst, func, overlap=0, width=None, height=None, workers=None, processes=False,
+                    ordered=False, max_pending=None, boundless=False, cached=False, stats=None):
+    """ Run func over each window of src in a thread (or process) pool and write the results to dst
+
+        Each window (width x height tiles or src blocks) is read with overlap pixels either side,
+        func is called with the (bands, rows, cols) array and must return an array of the same rows & cols,
+        2D or (bands, rows, cols). The overlap is trimmed and the core written to the same window of dst.
+
+        Reads and writes happen in the calling thread as datasets aren't thread safe. At most max_pending
+        (default 2 * workers) windows are in flight. Results are written as they finish, or in window
+        order if ordered=True. With processes=True, func must be picklable, i.e. a module level function.
+
+        cached=True reads through cached_windows (in row major order) so each src block is only read once,
+        stats is passed on to it. Not supported with boundless=True.
+    """
+    workers = workers or os.cpu_count()
+    max_pending = max_pending or workers * 2
+    big_window = windows.Window(col_off=0, row_off=0, width=src.meta['width'], height=src.meta['height'])
+
+    def write(result, core, window):
+        rows = slice(int(core.row_off - window.row_off), int(core.row_off - window.row_off + core.height))
+        cols = slice(int(core.col_off - window.col_off), int(core.col_off - window.col_off + core.width))
+        if result.ndim == 2:
+            dst.write(result[rows, cols], 1, window=core)
+        else:
+            dst.write(result[:, rows, cols], window=core)
+
+    def reads():
+        if cached:
+            for core, window, arr in _cached_reads(src, overlap, width, height, stats):
+                yield core, window, arr
+            return
+
+        for core in _core_windows(src, width, height):
+            window = windows.Window(
+                col_off=core.col_off - overlap,
+                row_off=core.row_off - overlap,
+                width=core.width + overlap * 2,
+                height=core.height + overlap * 2)
+            if not boundless:
+                window = window.intersection(big_window)
+            yield core, window, src.read(window=window, boundless=boundless)
+
+    if cached and boundless:
+        raise ValueError('cached reads do not support boundless windows')
+
+    with (ProcessPoolExecutor if processes else ThreadPoolExecutor)(workers) as pool:
+        pending = deque() if ordered else {}
+        for core, window, arr in reads():
+            future = pool.submit(func, arr)
+            if ordered:
+                pending.append((future, core, window))
+                if len(pending) >= max_pending:
+                    future, core, window = pending.popleft()
+                    write(future.result(), core, window)
+            else:
+                pending[future] = core, window
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        write(future.result(), *pending.pop(future))
+
+        while pending:
+            if ordered:
+                future, core, window = pending.popleft()
+                write(future.result(), core, window)
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write(future.result(), *pending.pop(future))
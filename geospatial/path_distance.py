@@ -7,16 +7,41 @@ to a flow direction raster `flowdir = Int(0.5 * 2 ** backlink)`
 However... this is significantly faster than the ArcGIS tool: for a 250m raster covering continental Australia (18500*16500 pixels) 
 this script takes ~1min, while the ArcGIS FlowLength tool takes >15min, not including the time to calculate the flow direction raster. 
 Although ArcGIS can process larger rasters as it doesn't read the whole thing into memory.
+Pass `tiled=True` to process the raster a block (or `tile_size` tile) at a time, paths that cross a tile edge
+are resolved through a small table of tile edge cells so peak memory depends on the tile size, not the raster size.
+Pass `method='memo'` to visit each cell once instead of walking the full path from every cell,
+each cell's distance is its step plus the already calculated distance of the cell it links to.
+The 'memo' method can also output flow accumulation (number of upstream cells) and allocation
+(the source each cell drains to) rasters from the same traversal.
 
 License is Apache 2.0
 
 """
+import os
+import time
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
 import rasterio, numpy, numba
 
+from overlapping_windows import overlapping_blocks, overlapping_tiles
+
+# Row/col offsets indexed by backlink value, 0 = source
+_DROW = numpy.array([0, 0, 1, 1, 1, 0, -1, -1, -1])
+_DCOL = numpy.array([0, 1, 1, 0, -1, -1, -1, 0, 1])
+
+# Tile size for tiled mode on striped rasters, whose blocks of one or a few full width rows
+# would make nearly every cell an edge cell
+STRIPED_TILE_SIZE = 512
 
-@numba.jit(nopython=True, nogil=True, parallel=True, fastmath=True)
-def _path_distance(arr, output, nodata, multiplier=1.0):
-    for row in range(arr.shape[0]):
+
+@numba.jit(nopython=True, nogil=True, fastmath=True)
+def _path_distance(arr, output, nodata, multiplier, row_start, row_stop):
+    """ Walk the paths from every cell in rows row_start to row_stop
+
+        Releases the GIL so row bands can be run in parallel threads, see _path_distance_parallel
+    """
+    for row in range(row_start, row_stop):
         for col in range(arr.shape[1]):
             idx = start_idx = row, col
             path = arr[idx].item()
@@ -55,11 +80,499 @@ def _path_distance(arr, output, nodata, multiplier=1.0):
                 i += 1
             output[start_idx] = dist
 
-        if row % 100 == 0:
-            print(row)
 
+def _path_distance_parallel(arr, output, nodata, multiplier=1.0, workers=None, progress=None, band_rows=64):
+    """ Run _path_distance over bands of band_rows rows in a thread pool
+
+        progress is called as progress(rows_done, rows_total, rows_per_second) as each band finishes
+    """
+    rows = arr.shape[0]
+    done = 0
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for row_start in range(0, rows, band_rows):
+            row_stop = min(row_start + band_rows, rows)
+            futures[pool.submit(_path_distance, arr, output, nodata, multiplier, row_start, row_stop)] = row_stop - row_start
+
+        for future in as_completed(futures):
+            future.result()
+            done += futures[future]
+            if progress is not None:
+                progress(done, rows, done / max(time.perf_counter() - start_time, 1e-9))
+
+
+def print_progress(rows_done, rows_total, rows_per_second):
+    print('{}/{} rows ({:.0f} rows/s)'.format(rows_done, rows_total, rows_per_second))
+
+
+@numba.jit(nopython=True, nogil=True, fastmath=True)
+def _walk_tile(arr, row_off, col_off, height, width, nodata, multiplier, edges_only, dist, exits):
+    """ Walk each path until it terminates or leaves the tile
+
+        dist is the distance walked within the tile and exits the flat (row * width + col) index
+        of the first cell outside the tile, or -1 if the path terminated inside the tile.
+        Paths that hit nodata, leave the raster or loop within the tile get a dist of -1.
+    """
+    rows, cols = arr.shape
+    max_steps = rows * cols
+    for row in range(rows):
+        for col in range(cols):
+            if edges_only and 0 < row < rows - 1 and 0 < col < cols - 1:
+                continue
+            r, c = row, col
+            d = 0.0
+            exit_idx = -1
+            i = 0
+            while True:
+                path = arr[r, c]
+                if path == 0:
+                    break
+                elif path == nodata or i == max_steps:
+                    d = -1.0
+                    break
+                elif path % 2 == 1:  # Odd = up/down/left/right
+                    d += (1 * multiplier)
+                else:  # Even = diagonal
+                    d += (2.0 ** 0.5 * multiplier)
+
+                r, c = r + _DROW[path], c + _DCOL[path]
+                if not (0 <= r < rows and 0 <= c < cols):
+                    r, c = r + row_off, c + col_off
+                    if 0 <= r < height and 0 <= c < width:
+                        exit_idx = r * width + c
+                    else:
+                        d = -1.0
+                    break
+                i += 1
+
+            dist[row, col] = d
+            exits[row, col] = exit_idx
+
+
+@numba.jit(nopython=True, nogil=True, fastmath=True)
+def _memo_tile(arr, row_off, col_off, height, width, nodata, multiplier, dist, exits, sources):
+    """ Memoized version of _walk_tile, each cell is visited once
+
+        A path is followed until it reaches an already resolved cell, a source, nodata, a cycle or the
+        edge of the tile, then unwound setting dist = step + dist of the next cell for every cell on it.
+        sources is the flat (row * width + col) index of the source each path ends at, or -1 if it
+        doesn't end at a source or leaves the tile.
+        Pass empty exits/sources arrays if they aren't needed, e.g. exits when the tile is the whole raster.
+    """
+    rows, cols = arr.shape
+    track = exits.size > 0
+    track_src = sources.size > 0
+    state = numpy.zeros(arr.shape, numpy.uint8)  # 0 = unvisited, 1 = on the stack, 2 = resolved
+    stack = numpy.empty(rows * cols, numpy.int64)  # Only touched as deep as the longest path
+    for row in range(rows):
+        for col in range(cols):
+            if state[row, col] == 2:
+                continue
+
+            top = 0
+            r, c = row, col
+            exit_idx = -1
+            src = -1
+            while True:
+                if state[r, c] == 2:
+                    base = dist[r, c]
+                    if track:
+                        exit_idx = exits[r, c]
+                    if track_src:
+                        src = sources[r, c]
+                    break
+                elif state[r, c] == 1:  # Cycle
+                    base = -1.0
+                    break
+
+                path = arr[r, c]
+                if path == 0 or path == nodata:
+                    base = dist[r, c] = 0.0 if path == 0 else -1.0
+                    if path == 0:
+                        src = (r + row_off) * width + c + col_off
+                    if track:
+                        exits[r, c] = -1
+                    if track_src:
+                        sources[r, c] = src
+                    state[r, c] = 2
+                    break
+
+                state[r, c] = 1
+                stack[top] = r * cols + c
+                top += 1
+                r, c = r + _DROW[path], c + _DCOL[path]
+                if not (0 <= r < rows and 0 <= c < cols):
+                    r, c = r + row_off, c + col_off
+                    if 0 <= r < height and 0 <= c < width:
+                        exit_idx = r * width + c
+                        base = 0.0
+                    else:
+                        base = -1.0
+                    break
+
+            while top > 0:
+                top -= 1
+                r, c = stack[top] // cols, stack[top] % cols
+                if base < 0:
+                    base = -1.0
+                    exit_idx = -1
+                    src = -1
+                elif arr[r, c] % 2 == 1:  # Odd = up/down/left/right
+                    base = (1 * multiplier) + base
+                else:  # Even = diagonal
+                    base = (2.0 ** 0.5 * multiplier) + base
+                dist[r, c] = base
+                if track:
+                    exits[r, c] = exit_idx
+                if track_src:
+                    sources[r, c] = src
+                state[r, c] = 2
+
+
+@numba.jit(nopython=True, nogil=True)
+def _accumulate_tile(arr, valid, acc, outflow):
+    """ Add the number of upstream cells within the tile to acc
+
+        Counts are passed downstream starting from cells with nothing upstream of them,
+        a cell is only passed on once everything upstream of it has been counted so each link is followed once.
+        outflow is set to the number of cells leaving the tile through each cell, pass an empty array to skip it.
+        Every cell downstream of a valid cell must be valid, i.e. valid = dist >= 0
+    """
+    rows, cols = arr.shape
+    track = outflow.size > 0
+    upstream = numpy.zeros(arr.shape, numpy.uint8)  # Number of upstream neighbours not yet counted
+    for r in range(rows):
+        for c in range(cols):
+            if valid[r, c] and arr[r, c] != 0:
+                nr, nc = r + _DROW[arr[r, c]], c + _DCOL[arr[r, c]]
+                if 0 <= nr < rows and 0 <= nc < cols:
+                    upstream[nr, nc] += 1
+
+    for row in range(rows):
+        for col in range(cols):
+            if not valid[row, col] or upstream[row, col] != 0:
+                continue
+            r, c = row, col
+            while True:
+                upstream[r, c] = 255  # Done
+                path = arr[r, c]
+                if path == 0:
+                    break
+                nr, nc = r + _DROW[path], c + _DCOL[path]
+                if not (0 <= nr < rows and 0 <= nc < cols):
+                    if track:
+                        outflow[r, c] = acc[r, c] + 1
+                    break
+                acc[nr, nc] += acc[r, c] + 1
+                upstream[nr, nc] -= 1
+                if upstream[nr, nc] != 0:
+                    break
+                r, c = nr, nc
+
+
+@numba.jit(nopython=True, nogil=True)
+def _accumulate_edges(target, inflow):
+    """ Pass the inflow of each tile edge cell on to the edge cell its path exits the tile to """
+    n = target.shape[0]
+    upstream = numpy.zeros(n, numpy.int64)
+    for i in range(n):
+        if target[i] >= 0:
+            upstream[target[i]] += 1
+
+    for i in range(n):
+        j = i
+        while upstream[j] == 0:
+            upstream[j] = -1  # Done
+            t = target[j]
+            if t < 0:
+                break
+            inflow[t] += inflow[j]
+            upstream[t] -= 1
+            j = t
+
+
+def _path_distance_memo(arr, output, nodata, multiplier=1.0, accumulation=None, allocation=None):
+    dist = numpy.empty(arr.shape)
+    empty = numpy.empty((0, 0), numpy.int64)
+    sources = empty if allocation is None else numpy.empty(arr.shape, numpy.int64)
+    _memo_tile(arr, 0, 0, arr.shape[0], arr.shape[1], nodata, multiplier, dist, empty, sources)
+    output[:] = dist
+
+    if allocation is not None:
+        allocation[:] = sources
+        del sources
+
+    if accumulation is not None:
+        valid = dist >= 0
+        del dist
+        acc = numpy.zeros(arr.shape, numpy.int64)
+        _accumulate_tile(arr, valid, acc, empty)
+        acc[~valid] = -1
+        accumulation[:] = acc
+
+
+def _trace_tile(arr, row_off, col_off, height, width, nodata, multiplier, method, edges_only=False,
+                sources=False):
+    """ Run the walk or memo tile kernel
+
+        Returns the dist, exits and sources arrays, sources is empty unless requested (memo only)
+    """
+    dist = numpy.empty(arr.shape)
+    exits = numpy.empty(arr.shape, dtype=numpy.int64)
+    src = numpy.empty(arr.shape if sources else (0, 0), dtype=numpy.int64)
+    if method == 'memo':
+        _memo_tile(arr, row_off, col_off, height, width, nodata, multiplier, dist, exits, src)
+    else:
+        _walk_tile(arr, row_off, col_off, height, width, nodata, multiplier, edges_only, dist, exits)
+    return dist, exits, src
+
+
+@numba.jit(nopython=True, nogil=True)
+def _resolve_edges(dist, target, sources):
+    """ Resolve the full path distance (and source if sources isn't empty) of each tile edge cell
+
+        target is the index of the edge cell each path exits to, or -1 if it terminated in its own tile
+    """
+    n = dist.shape[0]
+    track_src = sources.size > 0
+    resolved = numpy.empty(n)
+    resolved_src = numpy.full(n if track_src else 0, -1, numpy.int64)
+    state = numpy.zeros(n, numpy.uint8)  # 0 = unvisited, 1 = on the stack, 2 = resolved
+    stack = numpy.empty(n, numpy.int64)
+    for i in range(n):
+        top = 0
+        j = i
+        while state[j] == 0 and target[j] >= 0:
+            state[j] = 1
+            stack[top] = j
+            top += 1
+            j = target[j]
+
+        src = -1
+        if state[j] == 0:  # Terminated within its tile
+            base = resolved[j] = dist[j]
+            if track_src:
+                src = resolved_src[j] = sources[j]
+            state[j] = 2
+        elif state[j] == 1:  # Cycle
+            base = -1.0
+        else:
+            base = resolved[j]
+            if track_src:
+                src = resolved_src[j]
+
+        while top > 0:
+            top -= 1
+            k = stack[top]
+            if base >= 0 and dist[k] >= 0:
+                base = dist[k] + base
+            else:
+                base = -1.0
+                src = -1
+            resolved[k] = base
+            if track_src:
+                resolved_src[k] = src
+            state[k] = 2
+
+    return resolved, resolved_src
+
+
+def _edge_index(shape, row_off, col_off, width):
+    """ Flat raster indices of the edge cells of a tile, in row major order """
+    rows, cols = numpy.indices(shape)
+    edges = numpy.zeros(shape, dtype=bool)
+    edges[[0, -1], :] = edges[:, [0, -1]] = True
+    return (rows[edges] + row_off) * width + cols[edges] + col_off, edges
+
+
+def _map_tiles(ras, windows, func, workers=None, progress=None, rows_total=None, counter=None):
+    """ Yield (window, func(arr, window)) for each window as they finish
+
+        Tiles are read in the calling thread as datasets aren't thread safe and func is run in a thread pool,
+        with at most 2 * workers tiles in flight. progress is called as progress(rows_done, rows_total,
+        rows_per_second) as each tile finishes, counting a tile as its share of the raster's rows.
+        counter holds the 'cells' done and 'start' time, so the count can carry on over several passes.
+    """
+    max_pending = 2 * (workers or os.cpu_count())
+
+    def finished(future, window):
+        if progress is not None:
+            counter['cells'] += window.height * window.width
+            rows_done = counter['cells'] / ras.width
+            progress(int(rows_done), rows_total, rows_done / max(time.perf_counter() - counter['start'], 1e-9))
+        return window, future.result()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for window in windows:
+            pending[pool.submit(func, ras.read(1, window=window), window)] = window
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield finished(future, pending.pop(future))
+
+        for future in as_completed(pending):
+            yield finished(future, pending[future])
+
+
+def _path_distance_tiled(ras, dst, windows, nodata, multiplier, method='walk', acc_dst=None, alloc_dst=None,
+                         workers=None, progress=None):
+    """ Calculate path distance a tile at a time, tiles are traced in a thread pool of workers threads
+
+        progress is called as each tile finishes, see _map_tiles. Every tile is traced twice,
+        so rows_total is twice the raster height.
+    """
+    height, width = ras.height, ras.width
+    accumulate = acc_dst is not None
+    allocate = alloc_dst is not None
+    empty = numpy.empty((0, 0), numpy.int64)
+    counter = {'cells': 0, 'start': time.perf_counter()}
+
+    # First pass, walk only the edge cells of each tile to build a table of
+    # where paths leave each tile and how far they travelled to get there
+    def trace_edges(arr, window):
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        dist, exit_idx, src = _trace_tile(arr, row_off, col_off, height, width, nodata, multiplier, method,
+                                          True, allocate)
+        idx, edges = _edge_index(arr.shape, row_off, col_off, width)
+        outflow = None
+        if accumulate:  # Number of cells in this tile flowing into the next tile, by entry cell
+            outflow = numpy.zeros(arr.shape, numpy.int64)
+            _accumulate_tile(arr, dist >= 0, numpy.zeros(arr.shape, numpy.int64), outflow)
+            leaving = outflow > 0
+            outflow = numpy.stack((exit_idx[leaving], outflow[leaving]))
+        return idx, dist[edges], exit_idx[edges], src[edges] if allocate else None, outflow
+
+    keys, dists, exits, sources, outflows = [], [], [], [], []
+    for window, (idx, dist, exit_idx, src, outflow) in _map_tiles(ras, windows, trace_edges, workers, progress,
+                                                                   2 * height, counter):
+        keys.append(idx)
+        dists.append(dist)
+        exits.append(exit_idx)
+        if allocate:
+            sources.append(src)
+        if accumulate:
+            outflows.append(outflow)
+
+    keys, dists, exits = numpy.concatenate(keys), numpy.concatenate(dists), numpy.concatenate(exits)
+    order = numpy.argsort(keys)
+    keys, dists, exits = keys[order], dists[order], exits[order]
+    sources = numpy.concatenate(sources)[order] if allocate else numpy.empty(0, numpy.int64)
+    del order
+
+    # A path leaving a tile always enters the next one on an edge cell
+    target = numpy.full(keys.shape, -1, dtype=numpy.int64)
+    crossing = exits >= 0
+    target[crossing] = numpy.searchsorted(keys, exits[crossing])
+    resolved, resolved_src = _resolve_edges(dists, target, sources)
+    del dists, exits, sources
+
+    if accumulate:  # Number of cells from other tiles flowing into each edge cell
+        inflow = numpy.zeros(keys.shape, numpy.int64)
+        outflows = numpy.concatenate(outflows, axis=1)
+        numpy.add.at(inflow, numpy.searchsorted(keys, outflows[0]), outflows[1])
+        del outflows
+        _accumulate_edges(target, inflow)
+    del target
+
+    # Second pass, walk every cell and carry on from the resolved edge cell distances
+    def trace_cells(arr, window):
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        dist, exit_idx, src = _trace_tile(arr, row_off, col_off, height, width, nodata, multiplier, method,
+                                          sources=allocate)
+
+        crossing = (exit_idx >= 0) & (dist >= 0)
+        pos = numpy.searchsorted(keys, exit_idx[crossing])
+        carried = resolved[pos]
+        dist[crossing] = numpy.where(carried >= 0, dist[crossing] + carried, -1.0)
+        if allocate:
+            src[crossing] = resolved_src[pos]
+        del exit_idx, crossing, pos, carried
+
+        acc = None
+        if accumulate:
+            valid = dist >= 0
+            acc = numpy.zeros(arr.shape, numpy.int64)
+            idx, edges = _edge_index(arr.shape, row_off, col_off, width)
+            acc[edges] = inflow[numpy.searchsorted(keys, idx)]
+            _accumulate_tile(arr, valid, acc, empty)
+            acc[~valid] = -1
+        return dist, src, acc
+
+    for window, (dist, src, acc) in _map_tiles(ras, windows, trace_cells, workers, progress, 2 * height, counter):
+        dst.write(dist.astype(dst.dtypes[0])[numpy.newaxis], window=window)
+        if allocate:
+            alloc_dst.write(src.astype(alloc_dst.dtypes[0])[numpy.newaxis], window=window)
+        if accumulate:
+            acc_dst.write(acc.astype(acc_dst.dtypes[0])[numpy.newaxis], window=window)
+
+
+def _int_profile(md, height, width):
+    """ Copy of profile md for the accumulation and allocation rasters """
+    md = md.copy()
+    md['dtype'] = 'int32' if height * width < 2 ** 31 else 'int64'
+    md['nodata'] = -1
+    return md
+
+
+def path_distance(backlink_raster, output_raster, tiled=False, tile_size=None, method='walk',
+                  workers=None, progress=None, accumulation_raster=None, allocation_raster=None):
+    """ Calculate path distance from a backlink raster
+
+        tiled: process the raster a tile at a time instead of reading it all into memory
+        tile_size: tile width/height in pixels, defaults to the raster's internal blocks,
+                   or STRIPED_TILE_SIZE for striped rasters (the GDAL default), which get tiled outputs.
+        method: 'walk' follows the path from every cell (paths are cut off at 10000 steps),
+                'memo' visits each cell once and sets cycles and paths that leave the raster to nodata.
+                'memo' needs a float64 scratch array the size of the raster unless tiled.
+        workers: number of threads (row bands untiled, or tiles if tiled), defaults to the number of CPUs.
+                 Not supported by the untiled 'memo' method, which is a single traversal.
+        progress: callable called as progress(rows_done, rows_total, rows_per_second)
+                  e.g. print_progress or something that calls arcpy.SetProgressorPosition.
+                  Tiled mode calls it as each tile finishes, tiles are traced twice so rows_total is twice the height.
+                  Not supported by the untiled 'memo' method.
+        accumulation_raster: optional output of the number of upstream cells draining through each cell ('memo' only)
+        allocation_raster: optional output of the source each cell drains to ('memo' only),
+                           identified by its flat index i.e. row * width + col
+    """
+    if method not in ('walk', 'memo'):
+        raise ValueError("method must be 'walk' or 'memo', not {!r}".format(method))
+    if method != 'memo' and (accumulation_raster or allocation_raster):
+        raise ValueError("accumulation_raster and allocation_raster need method='memo'")
+    if method == 'memo' and not (tiled or tile_size) and (workers or progress):
+        raise ValueError("workers and progress need tiled=True with method='memo'")
+
+    if tiled or tile_size:
+        with rasterio.open(backlink_raster) as ras:
+            md = ras.profile
+            md['dtype'] = 'float32'
+            md['nodata'] = -1
+            block_height, block_width = ras.block_shapes[0]
+            striped = block_width == ras.width and block_height < STRIPED_TILE_SIZE
+            if not tile_size and striped:
+                tile_size = STRIPED_TILE_SIZE
+            if tile_size:
+                # Row by row, so each strip is decoded once per pass, not once per column of tiles
+                windows = sorted(overlapping_tiles(ras, 0, tile_size, tile_size),
+                                 key=lambda window: (window.row_off, window.col_off))
+            else:
+                windows = list(overlapping_blocks(ras))
+            if striped:  # Write tiles, partly written output strips would be flushed and rewritten
+                block_size = tile_size if tile_size % 16 == 0 else 256
+                md.update(tiled=True, blockxsize=block_size, blockysize=block_size)
 
-def path_distance(backlink_raster, output_raster):
+            with ExitStack() as stack:
+                dst = stack.enter_context(rasterio.open(output_raster, mode='w', **md))
+                int_md = _int_profile(md, ras.height, ras.width)
+                acc_dst = alloc_dst = None
+                if accumulation_raster:
+                    acc_dst = stack.enter_context(rasterio.open(accumulation_raster, mode='w', **int_md))
+                if allocation_raster:
+                    alloc_dst = stack.enter_context(rasterio.open(allocation_raster, mode='w', **int_md))
+                _path_distance_tiled(ras, dst, windows, ras.nodata, ras.res[0], method, acc_dst, alloc_dst,
+                                     workers, progress)
+        return
 
     with rasterio.open(backlink_raster) as ras:
         md = ras.profile
@@ -71,7 +584,17 @@ def path_distance(backlink_raster, output_raster):
     md['nodata'] = -1
     output = numpy.zeros(arr.shape, dtype=md['dtype'])
 
-    _path_distance(arr, output, nodata, res)
+    if method == 'memo':
+        int_md = _int_profile(md, *arr.shape)
+        accumulation = numpy.zeros(arr.shape, dtype=int_md['dtype']) if accumulation_raster else None
+        allocation = numpy.zeros(arr.shape, dtype=int_md['dtype']) if allocation_raster else None
+        _path_distance_memo(arr, output, nodata, res, accumulation, allocation)
+        for path, extra in ((accumulation_raster, accumulation), (allocation_raster, allocation)):
+            if extra is not None:
+                with rasterio.open(path, mode='w', **int_md) as ras:
+                    ras.write(extra[numpy.newaxis])
+    else:
+        _path_distance_parallel(arr, output, nodata, res, workers, progress)
 
     with rasterio.open(output_raster, mode='w', **md) as ras:
         ras.write(output[numpy.newaxis])
@@ -79,4 +602,4 @@ def path_distance(backlink_raster, output_raster):
 
 if __name__ == '__main__':
     import sys
-    path_distance(sys.argv[1:))  #Expects sys.argv[1:] == backlink_raster, output_raster
+    path_distance(*sys.argv[1:3], progress=print_progress)  #Expects sys.argv[1:] == backlink_raster, output_raster
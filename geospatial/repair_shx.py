@@ -1,5 +1,10 @@
 import os
-from shapefile import (Reader, Writer)
+import mmap
+import struct
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 try:  # Py2 (I haven't actually tested on python 2...)
     from StringIO import StringIO as IO
@@ -8,7 +13,278 @@ try:  # Py2 (I haven't actually tested on python 2...)
 except ImportError:  # Py3
     from io import BytesIO as IO
 
-def main(shp):
+HEADER_SIZE = 100  # Main file header, same for .shp and .shx
+RECORD_HEADER = struct.Struct('>ii')  # Record number, content length in 16 bit words
+POINT_TYPES = (1, 11, 21)  # Point, PointZ, PointM, all other non null types start with a bbox
+INDEX_HEADER = struct.Struct('<4sHHIII')  # Magic, node size, padding, no. items, no. records, no. levels
+INDEX_MAGIC = b'HRT1'
+
+
+def scan_records(shp, bboxes=False):
+    """ Scan the 8 byte record headers of a .shp, returns the shp header and an
+        array of (offset, content length) pairs in 16 bit words, as stored in a .shx
+        If bboxes is True, also returns an array of (xmin, ymin, xmax, ymax) per record read
+        from the start of each record's content, NaN for null shapes.
+
+        Raises ValueError if the records don't exactly fill the file
+    """
+    with open(shp, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < HEADER_SIZE:
+            raise ValueError('{} is too small to be a shapefile'.format(shp))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header = mm[:HEADER_SIZE]
+            if struct.unpack_from('>i', header)[0] != 9994:
+                raise ValueError('{} is not a shapefile'.format(shp))
+
+            index = array('i')
+            boxes = array('d')
+            pos = HEADER_SIZE
+            while pos + RECORD_HEADER.size <= size:
+                recnum, length = RECORD_HEADER.unpack_from(mm, pos)
+                if length < 0:
+                    raise ValueError('Invalid record {} header at byte {} in {}'.format(recnum, pos, shp))
+                index.append(pos // 2)
+                index.append(length)
+                if bboxes:
+                    boxes.extend(_record_bbox(mm, pos + RECORD_HEADER.size, length * 2))
+                pos += RECORD_HEADER.size + length * 2
+
+    if pos > size:
+        raise ValueError('Record {} at byte {} runs past the end of {} ({} bytes)'.format(
+            len(index) // 2, index[-2] * 2, shp, size))
+    elif pos < size:
+        raise ValueError('{} trailing bytes after the last record in {}'.format(size - pos, shp))
+
+    if bboxes:
+        return header, index, boxes
+    return header, index
+
+
+def _record_bbox(mm, pos, length):
+    """ Bounding box from the start of a record's content """
+    shape_type = struct.unpack_from('<i', mm, pos)[0] if length >= 4 else 0
+    if shape_type in POINT_TYPES and length >= 20:
+        x, y = struct.unpack_from('<2d', mm, pos + 4)
+        return x, y, x, y
+    elif shape_type != 0 and length >= 36:
+        return struct.unpack_from('<4d', mm, pos + 4)
+    return (float('nan'),) * 4
+
+
+def _hilbert(x, y):
+    """ Position of x, y (0 - 0xFFFF) along a Hilbert curve, port of the flatbush hilbert function """
+    a = x ^ y
+    b = 0xFFFF ^ a
+    c = 0xFFFF ^ (x | y)
+    d = x & (y ^ 0xFFFF)
+
+    A = a | (b >> 1)
+    B = (a >> 1) ^ a
+    C = ((c >> 1) ^ (b & (d >> 1))) ^ c
+    D = ((a & (c >> 1)) ^ (d >> 1)) ^ d
+
+    a, b, c, d = A, B, C, D
+    A = (a & (a >> 2)) ^ (b & (b >> 2))
+    B = (a & (b >> 2)) ^ (b & ((a ^ b) >> 2))
+    C ^= (a & (c >> 2)) ^ (b & (d >> 2))
+    D ^= (b & (c >> 2)) ^ ((a ^ b) & (d >> 2))
+
+    a, b, c, d = A, B, C, D
+    A = (a & (a >> 4)) ^ (b & (b >> 4))
+    B = (a & (b >> 4)) ^ (b & ((a ^ b) >> 4))
+    C ^= (a & (c >> 4)) ^ (b & (d >> 4))
+    D ^= (b & (c >> 4)) ^ ((a ^ b) & (d >> 4))
+
+    a, b, c, d = A, B, C, D
+    C ^= (a & (c >> 8)) ^ (b & (d >> 8))
+    D ^= (b & (c >> 8)) ^ ((a ^ b) & (d >> 8))
+
+    a = C ^ (C >> 1)
+    b = D ^ (D >> 1)
+
+    i0 = x ^ y
+    i1 = b | (0xFFFF ^ (i0 | a))
+
+    i0 = (i0 | (i0 << 8)) & 0x00FF00FF
+    i0 = (i0 | (i0 << 4)) & 0x0F0F0F0F
+    i0 = (i0 | (i0 << 2)) & 0x33333333
+    i0 = (i0 | (i0 << 1)) & 0x55555555
+
+    i1 = (i1 | (i1 << 8)) & 0x00FF00FF
+    i1 = (i1 | (i1 << 4)) & 0x0F0F0F0F
+    i1 = (i1 | (i1 << 2)) & 0x33333333
+    i1 = (i1 | (i1 << 1)) & 0x55555555
+
+    return ((i1 << 1) | i0) & 0xFFFFFFFF
+
+
+def write_spatial_index(path, index, boxes, node_size=16):
+    """ Write a packed Hilbert R-tree (flatbush layout) of record bboxes to path
+
+        index is the .shx style (offset, length) array and boxes the bboxes from scan_records.
+        Little endian layout: INDEX_HEADER, level bounds (uint32), node boxes (4 x float64),
+        node indices (uint32, record number for leaves, first child for parents),
+        record byte offsets in the .shp (uint32).
+    """
+    items = [i for i in range(len(boxes) // 4) if boxes[i * 4] == boxes[i * 4]]  # Skip NaN (null shapes)
+    num_items = len(items)
+
+    level_bounds = [num_items]
+    num, num_nodes = num_items, num_items
+    while num_items and num != 1:
+        num = (num + node_size - 1) // node_size
+        num_nodes += num
+        level_bounds.append(num_nodes)
+
+    if num_items:
+        xmin = min(boxes[i * 4] for i in items)
+        ymin = min(boxes[i * 4 + 1] for i in items)
+        xmax = max(boxes[i * 4 + 2] for i in items)
+        ymax = max(boxes[i * 4 + 3] for i in items)
+        width, height = (xmax - xmin) or 1, (ymax - ymin) or 1
+
+        def hilbert(i):
+            x = (boxes[i * 4] + boxes[i * 4 + 2]) / 2
+            y = (boxes[i * 4 + 1] + boxes[i * 4 + 3]) / 2
+            return _hilbert(int(0xFFFF * (x - xmin) / width), int(0xFFFF * (y - ymin) / height))
+
+        items.sort(key=hilbert)
+
+    node_boxes = array('d')
+    indices = array('I', items)
+    for i in items:
+        node_boxes.extend(boxes[i * 4:i * 4 + 4])
+
+    pos = 0
+    for end in level_bounds[:-1]:
+        while pos < end:
+            start, stop = pos, min(pos + node_size, end)
+            node_boxes.append(min(node_boxes[j * 4] for j in range(start, stop)))
+            node_boxes.append(min(node_boxes[j * 4 + 1] for j in range(start, stop)))
+            node_boxes.append(max(node_boxes[j * 4 + 2] for j in range(start, stop)))
+            node_boxes.append(max(node_boxes[j * 4 + 3] for j in range(start, stop)))
+            indices.append(start)
+            pos = stop
+
+    offsets = array('I', (index[i] * 2 for i in range(0, len(index), 2)))
+    level_bounds = array('I', level_bounds if num_items else [])
+    for arr in (level_bounds, node_boxes, indices, offsets):
+        if sys.byteorder != 'little':
+            arr.byteswap()
+
+    with open(path, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, node_size, 0, num_items, len(offsets), len(level_bounds)))
+        for arr in (level_bounds, node_boxes, indices, offsets):
+            arr.tofile(f)
+
+
+class SpatialIndex(object):
+    """ Query a spatial index written by write_spatial_index, reading only the nodes needed
+
+        with SpatialIndex('roads.hrt') as idx:
+            for recnum, offset in idx.query(xmin, ymin, xmax, ymax):
+                ...
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.node_size, _, self.num_items, self.num_records, num_levels = INDEX_HEADER.unpack_from(self._mm)
+        if magic != INDEX_MAGIC:
+            raise ValueError('{} is not a spatial index'.format(path))
+        self._level_bounds = struct.unpack_from('<{}I'.format(num_levels), self._mm, INDEX_HEADER.size)
+        num_nodes = self._level_bounds[-1] if num_levels else 0
+        self._boxes = INDEX_HEADER.size + num_levels * 4
+        self._indices = self._boxes + num_nodes * 32
+        self._offsets = self._indices + num_nodes * 4
+
+    def query(self, xmin, ymin, xmax, ymax):
+        """ Record numbers (0 based) and .shp byte offsets of records whose bbox intersects the query bbox """
+        results = []
+        if not self.num_items:
+            return results
+
+        level = len(self._level_bounds) - 1
+        node = self._level_bounds[-1] - 1  # Root
+        queue = []
+        while True:
+            end = min(node + self.node_size, self._level_bounds[level])
+            for pos in range(node, end):
+                bxmin, bymin, bxmax, bymax = struct.unpack_from('<4d', self._mm, self._boxes + pos * 32)
+                if bxmax < xmin or bymax < ymin or bxmin > xmax or bymin > ymax:
+                    continue
+                index = struct.unpack_from('<I', self._mm, self._indices + pos * 4)[0]
+                if node < self.num_items:
+                    results.append(index)
+                else:
+                    queue.append((index, level - 1))
+            if not queue:
+                break
+            node, level = queue.pop()
+
+        return [(recnum, struct.unpack_from('<I', self._mm, self._offsets + recnum * 4)[0])
+                for recnum in sorted(results)]
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def rebuild_shx(shp, spatial_index=False):
+    """ Rebuild a .shx from the record headers of the .shp without decoding any shapes
+
+        If spatial_index is True, also write a packed Hilbert R-tree (.hrt) from the record bboxes
+        read in the same pass, see SpatialIndex to query it.
+    """
+    shp, _ = os.path.splitext(shp)
+    if spatial_index:
+        header, index, boxes = scan_records(shp + '.shp', bboxes=True)
+        write_spatial_index(shp + '.hrt', index, boxes)
+    else:
+        header, index = scan_records(shp + '.shp')
+
+    header = bytearray(header)
+    struct.pack_into('>i', header, 24, (HEADER_SIZE + len(index) * 4) // 2)  # File length in 16 bit words
+    if sys.byteorder == 'little':
+        index.byteswap()  # .shx values are big endian
+
+    with open(shp + '.shx', 'wb') as f:
+        f.write(header)
+        index.tofile(f)
+
+
+def _repair(shp, spatial_index=False):
+    try:
+        rebuild_shx(shp, spatial_index)
+    except Exception as err:
+        return repr(err)
+
+
+def repair_tree(root, workers=None, missing_only=False, spatial_index=False):
+    """ Rebuild the .shx of every shapefile under root in a process pool
+
+        returns {shp: None if repaired or an error message}
+    """
+    shps = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            shp, ext = os.path.splitext(os.path.join(dirpath, filename))
+            if ext.lower() == '.shp' and not (missing_only and os.path.exists(shp + '.shx')):
+                shps.append(shp + ext)
+
+    with ProcessPoolExecutor(workers) as pool:
+        return dict(zip(shps, pool.map(partial(_repair, spatial_index=spatial_index), shps, chunksize=8)))
+
+
+def rebuild_shx_pyshp(shp):
+    """ Rebuild a .shx by decoding and rewriting every record with pyshp """
+    from shapefile import (Reader, Writer)
+
     shp, _ = os.path.splitext(shp)
     with IO() as shpio, IO() as dbfio:  # Don't overwrite existing .shp, .dbf
         with Reader(shp) as r, Writer(shp=shpio, dbf=dbfio, shx=shp+'.shx') as w:
@@ -17,6 +293,14 @@ def main(shp):
                 w.record(*rec.record)
                 w.shape(rec.shape)
 
+
+def main(shp):
+    if os.path.isdir(shp):
+        for path, error in repair_tree(shp).items():
+            if error is not None:
+                print('{}: {}'.format(path, error))
+    else:
+        rebuild_shx(shp)
+
 if __name__ == '__main__':
-    import sys
     main(sys.argv[1])
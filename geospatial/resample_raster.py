@@ -12,15 +12,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from contextlib import contextmanager
+from itertools import groupby
 
+import numpy as np
 import rasterio
 from rasterio import Affine, MemoryFile
+from rasterio.coords import BoundingBox
 from rasterio.enums import Resampling
+from rasterio.transform import array_bounds
+from rasterio.windows import Window, transform as window_transform
 
 
 @contextmanager
-def resample_raster(raster, out_path=None, scale=2):
+def resample_raster(raster, out_path=None, scale=2, windowed=False, workers=1, blocksize=256, overviews=True,
+                    resampling=Resampling.bilinear, zero_copy=False, cache=None):
     """ Resample a raster
 
         multiply the pixel size by the scale factor
@@ -34,6 +44,16 @@ def resample_raster(raster, out_path=None, scale=2):
         the resampled raster would have an output pixel size of 125m and dimensions of (2048, 2048)
 
         returns a DatasetReader instance from either a filesystem raster or MemoryFile (if out_path is None)
+
+        windowed=True resamples and writes one blocksize x blocksize output window at a time instead of
+        reading the whole resampled array, reading across workers threads if workers > 1 (the source is
+        reopened in each thread so raster must have been opened from a path). If overviews is True and the
+        source has an internal overview with a factor equal to scale, the overview is read instead.
+
+        zero_copy=True (with out_path None) returns an ArrayDataset wrapping the resampled array instead of
+        encoding it to a MemoryFile GTiff and decoding it again.
+        cache is an optional ResampleCache, resampled arrays are reused if the same source file (and mtime),
+        scale and resampling are requested again. Not used with windowed=True.
     """
     t = raster.transform
 
@@ -42,15 +62,42 @@ def resample_raster(raster, out_path=None, scale=2):
     height = int(raster.height / scale)
     width = int(raster.width / scale)
 
-    profile = src.profile
+    profile = raster.profile
     profile.update(transform=transform, driver='GTiff', height=height, width=width)
 
-    data = raster.read(
-            out_shape=(raster.count, height, width),
-            resampling=Resampling.bilinear,
-        )
+    if windowed:
+        profile.update(tiled=True, blockxsize=blocksize, blockysize=blocksize)
+        if out_path is None:
+            with MemoryFile() as memfile:
+                with memfile.open(**profile) as dataset:  # Open as DatasetWriter
+                    resample_windows(raster, dataset, scale, workers, overviews, resampling)
+
+                with memfile.open() as dataset:  # Reopen as DatasetReader
+                    yield dataset
+        else:
+            with rasterio.open(out_path, 'w', **profile) as dataset:
+                resample_windows(raster, dataset, scale, workers, overviews, resampling)
+
+            with rasterio.open(out_path) as dataset:
+                yield dataset
+        return
 
-    if out_path is None:
+    key = cache.key(raster, scale, resampling) if cache is not None else None
+    data = cache.get(key) if key is not None else None
+    if data is None:
+        data = raster.read(
+                out_shape=(raster.count, height, width),
+                resampling=resampling,
+            )
+        if key is not None:
+            cache.put(key, data)
+
+    if out_path is None and zero_copy:
+        with ArrayDataset(data, **profile) as dataset:
+            del data
+            yield dataset
+
+    elif out_path is None:
         with write_mem_raster(data, **profile) as dataset:
             del data
             yield dataset
@@ -61,6 +108,224 @@ def resample_raster(raster, out_path=None, scale=2):
             yield dataset
 
 
+def resample_windows(raster, dataset, scale=2, workers=1, overviews=True, resampling=Resampling.bilinear):
+    """ Resample raster into each block window of an open DatasetWriter
+
+        Each output window reads the matching (fractional) source window, GDAL reads the extra
+        source pixels the resampling kernel needs around it so the result matches a full read.
+        Windows are written as they finish with at most 2 * workers in memory.
+    """
+    x_scale, y_scale = raster.width / dataset.width, raster.height / dataset.height
+    level = None
+    if overviews and scale > 1 and scale in raster.overviews(1):
+        level = raster.overviews(1).index(scale)
+
+    local = threading.local()
+    opened = []
+
+    def source():
+        if workers == 1 and level is None:
+            return raster
+        if not hasattr(local, 'src'):  # Datasets aren't thread safe, open one per thread
+            local.src = rasterio.open(raster.name, overview_level=level)
+            opened.append(local.src)
+        return local.src
+
+    def read(window):
+        if level is not None:
+            return source().read(window=window)
+
+        src_window = Window(window.col_off * x_scale, window.row_off * y_scale,
+                            window.width * x_scale, window.height * y_scale)
+        return source().read(
+                window=src_window,
+                out_shape=(raster.count, window.height, window.width),
+                resampling=resampling,
+            )
+
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            pending = {}
+            for ji, window in dataset.block_windows(1):
+                pending[pool.submit(read, window)] = window
+                if len(pending) >= workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        dataset.write(future.result(), window=pending.pop(future))
+
+            for future in pending:
+                dataset.write(future.result(), window=pending[future])
+    finally:
+        for src in opened:
+            src.close()
+
+
+def build_pyramid(raster, scales=(2, 4, 8, 16), out_paths=None, resampling=Resampling.average,
+                  workers=1, blocksize=256):
+    """ Build multiple resampled levels in one cascaded pass
+
+        scales are relative to raster, in increasing order, e.g. (2, 4, 8, 16)
+        resampling is a Resampling method for all levels or a sequence of one per level
+
+        If out_paths (one per scale) are given, each level is written to its own GeoTIFF,
+        resampled window by window from the previous level instead of the full resolution raster.
+        Otherwise the levels are built as internal overviews of raster, which must be opened in 'r+' mode,
+        in one GDAL call per run of levels that share a resampling method. Each call resamples from the
+        full resolution raster, so with mixed methods a run is not derived from the previous run's levels,
+        pass out_paths for a true cascade.
+    """
+    if isinstance(resampling, Resampling):
+        resampling = [resampling] * len(scales)
+
+    if out_paths is None:
+        levels = zip(scales, resampling)
+        for method, group in groupby(levels, key=lambda level: level[1]):
+            raster.build_overviews([int(scale) for scale, _ in group], method)
+        return
+
+    t = raster.transform
+    previous, previous_scale = raster, 1
+    try:
+        for scale, method, out_path in zip(scales, resampling, out_paths):
+            profile = raster.profile
+            profile.update(transform=Affine(t.a * scale, t.b, t.c, t.d, t.e * scale, t.f),
+                           driver='GTiff', height=int(raster.height / scale), width=int(raster.width / scale),
+                           tiled=True, blockxsize=blocksize, blockysize=blocksize)
+
+            with rasterio.open(out_path, 'w', **profile) as dataset:
+                resample_windows(previous, dataset, scale / previous_scale, workers, False, method)
+
+            if previous is not raster:
+                previous.close()
+            previous, previous_scale = rasterio.open(out_path), scale
+    finally:
+        if previous is not raster:
+            previous.close()
+
+
+class ArrayDataset(object):
+    """ Read only, numpy backed stand in for a rasterio DatasetReader
+
+        Supports the common reader attributes and read(), which takes the same arguments as
+        DatasetReader.read and like it returns a new array. read(copy=False) returns a view of the
+        array instead (read only if the array came from a ResampleCache), unless out_dtype or out are given.
+        out_shape and boundless reads are passed on to rasterio through an in memory GTiff of the array.
+    """
+    def __init__(self, data, **profile):
+        self._data = data
+        self._profile = profile
+        self.name = '<ArrayDataset>'
+        self.mode = 'r'
+        self.closed = False
+
+    profile = property(lambda self: dict(self._profile))  # A copy, like DatasetReader.profile
+    count = property(lambda self: self._data.shape[0])
+    height = property(lambda self: self._data.shape[1])
+    width = property(lambda self: self._data.shape[2])
+    shape = property(lambda self: self._data.shape[1:])
+    indexes = property(lambda self: tuple(range(1, self.count + 1)))
+    dtypes = property(lambda self: tuple(str(self._data.dtype) for i in self.indexes))
+    transform = property(lambda self: self._profile['transform'])
+    crs = property(lambda self: self._profile.get('crs'))
+    nodata = property(lambda self: self._profile.get('nodata'))
+    res = property(lambda self: (abs(self.transform.a), abs(self.transform.e)))
+    bounds = property(lambda self: BoundingBox(*array_bounds(self.height, self.width, self.transform)))
+
+    @property
+    def meta(self):
+        return {key: self._profile.get(key) for key in
+                ('driver', 'dtype', 'nodata', 'width', 'height', 'count', 'crs', 'transform')}
+
+    def read(self, indexes=None, out=None, window=None, masked=False, out_shape=None, boundless=False,
+             resampling=Resampling.nearest, fill_value=None, out_dtype=None, copy=True):
+        if out_shape is not None or boundless:
+            with write_mem_raster(self._data, **self._profile) as dataset:
+                return dataset.read(indexes, out=out, window=window, masked=masked, out_shape=out_shape,
+                                    boundless=boundless, resampling=resampling, fill_value=fill_value,
+                                    out_dtype=out_dtype)
+
+        if indexes is None:
+            data = self._data
+        elif isinstance(indexes, int):
+            data = self._data[indexes - 1]
+        else:
+            data = self._data[[i - 1 for i in indexes]]
+
+        if window is not None:
+            if not isinstance(window, Window):
+                window = Window.from_slices(*window)
+            rows, cols = window.toslices()
+            data = data[..., rows, cols]
+
+        if out is not None:
+            np.copyto(out, data, casting='unsafe')
+            data = out
+        elif out_dtype is not None:
+            data = data.astype(out_dtype)
+        elif copy:
+            data = data.copy()
+
+        if masked:
+            data = (np.ma.masked_equal(data, self.nodata, copy=False) if self.nodata is not None
+                    else np.ma.masked_array(data))
+        return data
+
+    def window_transform(self, window):
+        return window_transform(window, self.transform)
+
+    def close(self):
+        self._data = None
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ResampleCache(object):
+    """ Thread safe LRU cache of resampled arrays, least recently used arrays are evicted
+        once the cached arrays total more than max_bytes.
+    """
+    def __init__(self, max_bytes=2 ** 30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = self.misses = 0
+        self._arrays = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(raster, scale, resampling):
+        """ (source path, mtime, scale, resampling) or None if raster isn't a file on disk """
+        try:
+            return raster.name, os.stat(raster.name).st_mtime_ns, scale, resampling
+        except OSError:
+            return None
+
+    def get(self, key):
+        with self._lock:
+            data = self._arrays.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._arrays.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if data.nbytes > self.max_bytes:
+            return
+        data.flags.writeable = False  # Cached arrays are shared
+        with self._lock:
+            if key in self._arrays:
+                self.nbytes -= self._arrays.pop(key).nbytes
+            self._arrays[key] = data
+            self.nbytes += data.nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self._arrays.popitem(last=False)[1].nbytes
+
+
 @contextmanager
 def write_mem_raster(data, **profile):
     with MemoryFile() as memfile:
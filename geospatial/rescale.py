@@ -2,11 +2,98 @@
 License is Apache 2.0
 """
 
+try:
+    import numpy as np
+    import rasterio
+    from rasterio.enums import Resampling
+except ImportError:  # Only needed for rescale_raster, not the arcpy rescale
+    np = rasterio = Resampling = None
+
+
 def rescale(raster, out_min=0, out_max=1):
     arr_min, arr_max = raster.minimum, raster.maximum
     return out_min + ((((raster - arr_min)) * (out_max - out_min)) / (arr_max - arr_min))
 
 
+def _masked(arr):
+    """ Mask NaNs as well as nodata """
+    if arr.dtype.kind == 'f':
+        arr = np.ma.masked_invalid(arr)
+    return arr
+
+
+def raster_range(src, mode='exact', per_band=False, percentiles=None, sample_size=1024):
+    """ Get the (mins, maxs) of an open rasterio dataset, one value per band
+
+        mode: 'exact' reads every block, 'approx' reads a decimated copy no bigger than sample_size
+              pixels a side (GDAL reads from overviews if there are any)
+        per_band: if False the range across all bands is repeated for each band
+        percentiles: optional (low, high) percentiles to clip to instead of the min and max,
+                     always calculated from the decimated copy
+    """
+    if mode not in ('exact', 'approx'):
+        raise ValueError("mode must be 'exact' or 'approx', not {!r}".format(mode))
+
+    sample = None
+    if mode == 'approx' or percentiles is not None:
+        factor = max(src.width / sample_size, src.height / sample_size, 1)
+        out_shape = (src.count, max(int(src.height / factor), 1), max(int(src.width / factor), 1))
+        sample = _masked(src.read(out_shape=out_shape, masked=True, resampling=Resampling.nearest))
+
+    if percentiles is not None:
+        values = [sample[i].compressed() for i in range(src.count)]
+        if not per_band:
+            values = [np.concatenate(values)] * src.count
+        mins = np.array([np.percentile(v, percentiles[0]) for v in values])
+        maxs = np.array([np.percentile(v, percentiles[1]) for v in values])
+
+    elif mode == 'approx':
+        mins = np.array([sample[i].min() for i in range(src.count)], dtype=float)
+        maxs = np.array([sample[i].max() for i in range(src.count)], dtype=float)
+
+    else:
+        mins = np.full(src.count, np.inf)
+        maxs = np.full(src.count, -np.inf)
+        for ji, window in src.block_windows(1):
+            arr = _masked(src.read(window=window, masked=True))
+            for i in range(src.count):
+                if arr[i].count():
+                    mins[i] = min(mins[i], arr[i].min())
+                    maxs[i] = max(maxs[i], arr[i].max())
+
+    if not per_band:
+        mins[:], maxs[:] = mins.min(), maxs.max()
+    return mins, maxs
+
+
+def rescale_raster(in_raster, out_raster, out_min=0, out_max=255, dtype='uint8', mode='exact',
+                   per_band=False, percentiles=None, out_nodata=None, blocksize=256):
+    """ Rescale a raster to out_min - out_max with rasterio, a window at a time
+
+        The range is found with raster_range (see it for mode, per_band and percentiles),
+        then each window is rescaled, clipped to out_min - out_max and written directly as dtype.
+        Nodata/NaN pixels are written as out_nodata, or out_min if out_nodata is None.
+    """
+    with rasterio.open(in_raster) as src:
+        mins, maxs = raster_range(src, mode, per_band, percentiles)
+        ranges = np.where(maxs > mins, maxs - mins, np.inf)[:, np.newaxis, np.newaxis]
+        mins = mins[:, np.newaxis, np.newaxis]
+        integer = np.dtype(dtype).kind in 'iu'
+
+        profile = src.profile
+        profile.update(driver='GTiff', dtype=dtype, nodata=out_nodata,
+                       tiled=True, blockxsize=blocksize, blockysize=blocksize)
+
+        with rasterio.open(out_raster, 'w', **profile) as dst:
+            for ji, window in dst.block_windows(1):
+                arr = _masked(src.read(window=window, masked=True)).astype(np.float32)
+                arr = out_min + (arr - mins) * (out_max - out_min) / ranges
+                arr = np.ma.clip(arr, out_min, out_max)
+                if integer:
+                    arr = np.ma.round(arr)
+                arr = arr.filled(out_min if out_nodata is None else out_nodata)
+                dst.write(arr.astype(dtype), window=window)
+
 
 if __name__ == '__main__':
     import arcpy
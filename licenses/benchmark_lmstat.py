@@ -0,0 +1,96 @@
+# -*- coding: UTF-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        benchmark_lmstat
+# Purpose:     Compare lmstat parse throughput of the streaming parser against
+#              the old read everything then regex every line approach
+#
+# Author:      Luke
+#
+# Created:     21/05/2014
+# Copyright:   (c) 2014
+# Licence:     MIT
+#-------------------------------------------------------------------------------
+#!/usr/bin/env python
+'''
+Usage: benchmark_lmstat.py [--features N] [--users N] [--repeat N] [fixture]
+
+Parses a fixture file (or synthetic output from fake_lmstat) with both parsers,
+checks they agree and reports throughput. Also runs fake_lmstat.py as a subprocess
+to show how soon the first feature arrives when parsing the stream as it is written.
+'''
+import os,sys,time,argparse
+from collections import OrderedDict
+
+from lmstat import Command, parse_lmstat, FEATPAT, USERPAT
+import fake_lmstat
+
+def parse_buffered(stdout,featpat=FEATPAT,userpat=USERPAT):
+    '''The original LicenseInfo.get parser, for comparison'''
+    stdout=stdout[stdout.find('Users of'):]
+    featureinfo = OrderedDict()
+    for line in stdout.splitlines():
+        line=line.strip()
+        if line.startswith('Users of'):
+            r = featpat.search(line)
+            if r:
+                d = r.groupdict()
+                issued=d['issued']
+                inuse = d['inuse']
+                available = str(int(issued) - int(inuse))
+                feature=d['feature']
+                featureinfo[feature]={'issued':issued,
+                                   'inuse':inuse,
+                                   'available':available,
+                                   'users':[]
+                                   }
+        elif line:
+            r = userpat.search(line)
+            if r:
+                d = r.groupdict()
+                featureinfo[feature]['users'].append([d['userid'],d['computer'],d['date']])
+    return featureinfo
+
+def best(func,repeat):
+    times=[]
+    for i in range(repeat):
+        start=time.time()
+        result=func()
+        times.append(time.time()-start)
+    return min(times),result
+
+def main(args=None):
+    parser=argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('--features',type=int,default=2000)
+    parser.add_argument('--users',type=int,default=50000)
+    parser.add_argument('--repeat',type=int,default=5)
+    parser.add_argument('fixture',nargs='?')
+    args=parser.parse_args(args)
+
+    if args.fixture:
+        with open(args.fixture) as f:text=f.read()
+    else:
+        text='\n'.join(fake_lmstat.lmstat(args.features,args.users))+'\n'
+    lines=text.splitlines(True)
+    mb=len(text)/1024.0/1024.0
+
+    old,expected=best(lambda:parse_buffered(text),args.repeat)
+    new,result=best(lambda:OrderedDict(parse_lmstat(lines)),args.repeat)
+
+    if result!=expected:print('WARNING: parsers disagree')
+
+    users=sum(len(i['users']) for i in result.values())
+    print('%s lines, %.1f MB, %s features, %s users'%(len(lines),mb,len(result),users))
+    for name,secs in (('buffered',old),('streaming',new)):
+        print('%-10s %8.3fs %10.0f lines/s %6.1f MB/s'%(name,secs,len(lines)/secs,mb/secs))
+
+    if not args.fixture:
+        cmd=Command([sys.executable,os.path.join(os.path.dirname(os.path.abspath(__file__)),'fake_lmstat.py'),
+                     '--features',str(args.features),'--users',str(args.users)])
+        start=time.time()
+        first=None
+        for feature,info in parse_lmstat(cmd):
+            if first is None:first=time.time()-start
+        print('subprocess first feature after %.3fs, all %s features after %.3fs'%(first,len(result),time.time()-start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# -*- coding: UTF-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        benchmark_startup
+# Purpose:     Time licenses.pyw from launch to the main window's first paint
+#
+# Author:      Luke
+#
+# Created:     21/05/2014
+# Copyright:   (c) 2014
+# Licence:     MIT
+#-------------------------------------------------------------------------------
+#!/usr/bin/env python
+'''
+Usage: benchmark_startup.py [--repeat N]
+
+Starts licenses.pyw in a fresh python process N times and reports the median time from
+launch to the main window's first paint, split into interpreter start, imports, building
+the main window and showing it. Runs once with the compiled UI modules (see build_ui.py)
+and once with the .ui files parsed at runtime.
+'''
+import os,sys,time,json,subprocess,argparse
+
+here=os.path.dirname(os.path.abspath(__file__))
+
+#Run in the child process, launched is the parent's time.time() just before starting it
+CHILD='''
+import os,sys,time,json,runpy
+started=time.time()
+launched=float(sys.argv[1])
+sys.path.insert(0,%r)
+ns=runpy.run_path(%r,run_name='licenses')
+imported=time.time()
+QtCore,QtGui=ns['QtCore'],ns['QtGui']
+app=QtGui.QApplication(sys.argv)
+window=ns['MainWindow']()
+built=time.time()
+
+class FirstPaint(QtCore.QObject):
+    def eventFilter(self,obj,event):
+        if event.type()==QtCore.QEvent.Paint:
+            painted=time.time()
+            print(json.dumps({'interpreter':started-launched,'imports':imported-started,
+                              'window':built-imported,'paint':painted-built,'total':painted-launched}))
+            sys.stdout.flush()
+            os._exit(0) #don't hang around polling license servers
+        return False
+
+firstpaint=FirstPaint()
+window.installEventFilter(firstpaint)
+window.show()
+app.exec_()
+'''%(here,os.path.join(here,'licenses.pyw'))
+
+def median(values):
+    values=sorted(values)
+    return values[len(values)//2]
+
+def startup(runtime_ui=False):
+    env=dict(os.environ)
+    if runtime_ui:env['LICENSES_RUNTIME_UI']='1'
+    else:env.pop('LICENSES_RUNTIME_UI',None)
+    launched=time.time()
+    out=subprocess.check_output([sys.executable,'-c',CHILD,repr(launched)],env=env,cwd=here)
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+def main(args=None):
+    parser=argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('--repeat',type=int,default=5)
+    args=parser.parse_args(args)
+
+    if not os.path.exists(os.path.join(here,'licenses_ui.py')):
+        print('No compiled UI modules, run build_ui.py first to compare')
+
+    phases=('interpreter','imports','window','paint','total')
+    print('%-10s'%''+''.join('%12s'%p for p in phases))
+    for name,runtime_ui in (('compiled',False),('runtime',True)):
+        runs=[startup(runtime_ui) for i in range(args.repeat)]
+        print('%-10s'%name+''.join('%11.3fs'%median([r[p] for r in runs]) for p in phases))
+
+if __name__ == '__main__':
+    main()
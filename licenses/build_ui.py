@@ -0,0 +1,44 @@
+# -*- coding: UTF-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        build_ui
+# Purpose:     Compile the .ui files to python modules so licenses.pyw doesn't
+#              have to parse them every time it starts
+#
+# Author:      Luke
+#
+# Created:     21/05/2014
+# Copyright:   (c) 2014
+# Licence:     MIT
+#-------------------------------------------------------------------------------
+#!/usr/bin/env python
+'''
+Usage: build_ui.py
+
+Writes licenses_ui.py and settings_ui.py next to the .ui files. licenses.pyw uses them
+when they're there and newer than the .ui, otherwise it falls back to loading the .ui
+at runtime, so re-run this after editing either .ui file.
+'''
+import os,io
+
+try:
+    from PyQt4.uic import compileUi
+except ImportError:
+    from pysideuic import compileUi
+
+here=os.path.dirname(os.path.abspath(__file__))
+
+def build(name):
+    uifile=os.path.join(here,name+'.ui')
+    pyfile=os.path.join(here,name+'_ui.py')
+
+    out=io.BytesIO() if str is bytes else io.StringIO()
+    compileUi(uifile,out)
+    #the ui compilers assume licenses.qrc was compiled to licenses_rc.py, and
+    #guard the import the same way licenses.pyw does
+    source=out.getvalue().replace('import licenses_rc\n','try:import licenses_qrc\nexcept:pass\n')
+
+    with open(pyfile,'w') as f:f.write(source)
+    print('%s -> %s'%(uifile,pyfile))
+
+if __name__ == '__main__':
+    for name in ('licenses','settings'):build(name)
@@ -0,0 +1,312 @@
+# -*- coding: UTF-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        collector
+# Purpose:     Poll license managers on a schedule and keep the results in SQLite
+#              so clients don't all have to run lmutil themselves
+#
+# Author:      Luke
+#
+# Created:     21/05/2014
+# Copyright:   (c) 2014
+# Licence:     MIT
+#-------------------------------------------------------------------------------
+#!/usr/bin/env python
+'''
+Usage: collector.py [--db licenses.db] collect [--ini licenses.ini] [--interval 300] [--once]
+       collector.py [--db licenses.db] latest|peak|denials|usertime [--start] [--end] ...
+
+"collect" polls every manager listed in licenses.ini (or --ini) every --interval seconds
+and saves each result to the database. Point the "database" setting in licenses.ini at
+the same file and the license checker will read from it instead of running lmutil.
+
+The other commands report on what has been collected between --start and --end
+(YYYY-MM-DD [HH:MM], local time), e.g.
+
+    python collector.py peak --start 2014-05-01 --end 2014-06-01 --manager ArcGIS
+
+--lmutil "python fake_lmstat.py" collects from synthetic output for testing.
+'''
+import os,time,json,shlex,sqlite3,threading,argparse
+from collections import OrderedDict, defaultdict, namedtuple
+from datetime import datetime
+try:from ConfigParser import RawConfigParser, Error as ConfigError #py2
+except ImportError:from configparser import RawConfigParser, Error as ConfigError
+
+from lmstat import query
+
+SCHEMA='''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    manager TEXT NOT NULL,
+    polled REAL NOT NULL,   -- unix time
+    error TEXT              -- NULL if the poll worked
+);
+CREATE INDEX IF NOT EXISTS snapshots_polled ON snapshots (polled);
+CREATE INDEX IF NOT EXISTS snapshots_manager ON snapshots (manager, polled);
+
+CREATE TABLE IF NOT EXISTS features (
+    snapshot INTEGER NOT NULL REFERENCES snapshots (id),
+    feature TEXT NOT NULL,
+    issued INTEGER NOT NULL,
+    inuse INTEGER NOT NULL,
+    PRIMARY KEY (snapshot, feature)
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    snapshot INTEGER NOT NULL REFERENCES snapshots (id),
+    feature TEXT NOT NULL,
+    userid TEXT NOT NULL,
+    computer TEXT,
+    started TEXT            -- as lmstat reports it, e.g. "Mon 3/4 9:00"
+);
+CREATE INDEX IF NOT EXISTS users_snapshot ON users (snapshot, feature);
+CREATE INDEX IF NOT EXISTS users_userid ON users (userid);
+'''
+
+Peak = namedtuple('Peak','manager feature inuse issued polled')
+Denial = namedtuple('Denial','manager feature start end polls')
+UserTime = namedtuple('UserTime','userid manager feature seconds')
+
+def timestamp(value):
+    '''Unix time from a number, datetime or "YYYY-MM-DD [HH:MM[:SS]]" string (local time)'''
+    if value is None or isinstance(value,(int,float)):return value
+    if isinstance(value,datetime):return time.mktime(value.timetuple())
+    for fmt in ('%Y-%m-%d %H:%M:%S','%Y-%m-%d %H:%M','%Y-%m-%d'):
+        try:return time.mktime(datetime.strptime(value,fmt).timetuple())
+        except ValueError:pass
+    raise ValueError('Unrecognised date/time: %s'%value)
+
+class LicenseStore(object):
+    '''lmstat snapshots in a SQLite database'''
+    def __init__(self,path,create=True):
+        self.path=path
+        self.db=sqlite3.connect(path)
+        if create:self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def save(self,manager,featureinfo=None,error=None,polled=None):
+        '''Save the result of a poll, featureinfo as returned by lmstat.query'''
+        polled=time.time() if polled is None else timestamp(polled)
+        items=list((featureinfo or {}).items())
+        with self.db:
+            snapshot=self.db.execute('INSERT INTO snapshots (manager,polled,error) VALUES (?,?,?)',
+                                     (manager,polled,error)).lastrowid
+            self.db.executemany('INSERT INTO features VALUES (?,?,?,?)',
+                                ((snapshot,f,int(i['issued']),int(i['inuse'])) for f,i in items))
+            self.db.executemany('INSERT INTO users VALUES (?,?,?,?,?)',
+                                ((snapshot,f,u[0],u[1],u[2]) for f,i in items for u in i['users']))
+        return snapshot
+
+    def purge(self,before):
+        '''Delete snapshots polled before before'''
+        before=timestamp(before)
+        with self.db:
+            for table in ('users','features'):
+                self.db.execute('DELETE FROM %s WHERE snapshot IN (SELECT id FROM snapshots WHERE polled<?)'%table,(before,))
+            self.db.execute('DELETE FROM snapshots WHERE polled<?',(before,))
+
+    def managers(self):
+        return [r[0] for r in self.db.execute('SELECT DISTINCT manager FROM snapshots ORDER BY manager')]
+
+    def latest(self,manager):
+        '''(polled, featureinfo, error) from the last poll of manager, or None if it's never been polled.
+           featureinfo is in the same form LicenseInfo emits it.'''
+        row=self.db.execute('SELECT id,polled,error FROM snapshots WHERE manager=? ORDER BY polled DESC LIMIT 1',
+                            (manager,)).fetchone()
+        if row is None:return None
+
+        snapshot,polled,error=row
+        featureinfo=OrderedDict()
+        for feature,issued,inuse in self.db.execute(
+                'SELECT feature,issued,inuse FROM features WHERE snapshot=? ORDER BY rowid',(snapshot,)):
+            featureinfo[feature]={'issued':str(issued),
+                                  'inuse':str(inuse),
+                                  'available':str(issued-inuse),
+                                  'users':[]
+                                  }
+        for feature,userid,computer,started in self.db.execute(
+                'SELECT feature,userid,computer,started FROM users WHERE snapshot=? ORDER BY rowid',(snapshot,)):
+            featureinfo[feature]['users'].append([userid,computer,started])
+        return polled,featureinfo,error
+
+    def _where(self,start,end,manager=None,feature=None,table='f'):
+        clauses,params=['1'],[]
+        for clause,value in (('s.polled>=?',timestamp(start)),('s.polled<=?',timestamp(end)),
+                             ('s.manager=?',manager),(table+'.feature=?',feature)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        return ' AND '.join(clauses),params
+
+    def peak_usage(self,start=None,end=None,manager=None,feature=None):
+        '''Peak licenses in use of each feature between start and end, and when that peak was first seen'''
+        where,params=self._where(start,end,manager,feature)
+        rows=self.db.execute(
+            '''SELECT s.manager,f.feature,f.inuse,f.issued,s.polled
+               FROM features f JOIN snapshots s ON s.id=f.snapshot
+               WHERE %s ORDER BY s.manager,f.feature,f.inuse DESC,s.polled'''%where,params)
+        peaks=OrderedDict()
+        for row in rows:peaks.setdefault(row[:2],Peak(*row))
+        return list(peaks.values())
+
+    def denial_windows(self,start=None,end=None,manager=None,feature=None):
+        '''Periods between start and end when every license of a feature was in use, so anyone
+           else asking for one would have been denied (lmstat can't see actual denials).
+           Each window runs from the first poll that saw the feature fully used to the first poll
+           that saw a license free again, or the last poll in the range if none was.'''
+        where,params=self._where(start,end,manager,feature)
+        rows=self.db.execute(
+            '''SELECT s.manager,f.feature,s.polled,f.issued>0 AND f.inuse>=f.issued
+               FROM features f JOIN snapshots s ON s.id=f.snapshot
+               WHERE %s ORDER BY s.manager,f.feature,s.polled'''%where,params)
+
+        windows=[]
+        key=window=None
+        for manager,feature,polled,full in rows:
+            if (manager,feature)!=key:
+                if window:windows.append(Denial(*window))
+                key,window=(manager,feature),None
+            if full:
+                if window:
+                    window[3]=polled
+                    window[4]+=1
+                else:window=[manager,feature,polled,polled,1]
+            elif window:
+                window[3]=polled
+                windows.append(Denial(*window))
+                window=None
+        if window:windows.append(Denial(*window))
+        return windows
+
+    def user_time(self,start=None,end=None,manager=None,feature=None,userid=None,max_gap=900):
+        '''Total seconds each user had each feature checked out between start and end.
+
+           A user seen in a poll is credited with the time until that manager's next poll,
+           capped at max_gap seconds so collector outages don't count.'''
+        where,params=self._where(start,end,manager)
+        polls=self.db.execute('SELECT s.id,s.manager,s.polled FROM snapshots s WHERE %s ORDER BY s.manager,s.polled'%where,
+                              params)
+        durations={}
+        previous=None
+        for snapshot,manager_,polled in polls:
+            if previous and previous[1]==manager_:
+                durations[previous[0]]=min(polled-previous[2],max_gap)
+            previous=(snapshot,manager_,polled)
+
+        where,params=self._where(start,end,manager,feature,'u')
+        if userid is not None:
+            where+=' AND u.userid=?'
+            params.append(userid)
+        rows=self.db.execute(
+            '''SELECT DISTINCT u.snapshot,u.userid,s.manager,u.feature
+               FROM users u JOIN snapshots s ON s.id=u.snapshot WHERE %s'''%where,params)
+
+        totals=defaultdict(float)
+        for snapshot,userid_,manager_,feature_ in rows:
+            totals[(userid_,manager_,feature_)]+=durations.get(snapshot,0)
+        return [UserTime(*(key+(seconds,))) for key,seconds in sorted(totals.items())]
+
+def read_setting(ini,key,default=None):
+    '''Read a JSON setting from the [General] section of a QSettings ini file, e.g. licenses.ini'''
+    parser=RawConfigParser()
+    try:
+        parser.read(ini)
+        value=parser.get('General',key)
+    except ConfigError:return default
+    if value.startswith('"') and value.endswith('"'): #QSettings quotes and escapes strings
+        value=value[1:-1].replace('\\"','"').replace('\\\\','\\')
+    try:return json.loads(value)
+    except ValueError:return value
+
+def collect(managers,store,lmutil=('lmutil',),timeout=30):
+    '''Poll all managers at once and save a snapshot of each to store.
+       managers is a list of [server, port, manager] as in licenses.ini'''
+    results={}
+    def poll(server,port,manager):
+        polled=time.time()
+        results[manager]=(polled,)+query(server,port,timeout,lmutil=lmutil)
+
+    threads=[threading.Thread(target=poll,args=tuple(m)) for m in managers]
+    for thread in threads:thread.start()
+    for thread in threads:thread.join()
+
+    #sqlite connections can't be shared between threads, so save them all from here
+    for server,port,manager in managers:
+        polled,featureinfo,error=results[manager]
+        store.save(manager,featureinfo,error,polled)
+        yield manager,featureinfo,error
+
+def run(managers,path,interval=300,lmutil=('lmutil',),timeout=30,keep_days=None,once=False):
+    '''Collect every interval seconds until interrupted'''
+    with LicenseStore(path) as store:
+        while True:
+            start=time.time()
+            for manager,featureinfo,error in collect(managers,store,lmutil,timeout):
+                print('%s %s: %s'%(time.strftime('%Y-%m-%d %H:%M:%S'),manager,
+                                   error or '%s features'%len(featureinfo)))
+            if keep_days:store.purge(start-keep_days*86400)
+            if once:break
+            time.sleep(max(0,interval-(time.time()-start)))
+
+def formattime(t):
+    return time.strftime('%Y-%m-%d %H:%M',time.localtime(t))
+
+def main(args=None):
+    here=os.path.dirname(os.path.abspath(__file__))
+    parser=argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('--db',default='licenses.db')
+    commands=parser.add_subparsers(dest='command')
+
+    cmd=commands.add_parser('collect')
+    cmd.add_argument('--ini',default=os.path.join(here,'licenses.ini'))
+    cmd.add_argument('--interval',type=int,default=300)
+    cmd.add_argument('--timeout',type=int,default=30)
+    cmd.add_argument('--keep-days',type=int)
+    cmd.add_argument('--lmutil',default='lmutil')
+    cmd.add_argument('--once',action='store_true')
+
+    commands.add_parser('latest')
+    for name in ('peak','denials','usertime'):
+        cmd=commands.add_parser(name)
+        cmd.add_argument('--start')
+        cmd.add_argument('--end')
+        cmd.add_argument('--manager')
+        cmd.add_argument('--feature')
+        if name=='usertime':
+            cmd.add_argument('--user')
+            cmd.add_argument('--max-gap',type=int,default=900)
+    args=parser.parse_args(args)
+
+    if args.command=='collect':
+        managers=read_setting(args.ini,'managers',[])
+        lmutil=shlex.split(args.lmutil,posix=os.name!='nt')
+        try:run(managers,args.db,args.interval,lmutil,args.timeout,args.keep_days,args.once)
+        except KeyboardInterrupt:pass
+        return
+
+    with LicenseStore(args.db) as store:
+        if args.command=='latest':
+            for manager in store.managers():
+                polled,featureinfo,error=store.latest(manager)
+                print('%s\t%s\t%s'%(manager,formattime(polled),error or '%s features'%len(featureinfo)))
+        elif args.command=='peak':
+            for peak in store.peak_usage(args.start,args.end,args.manager,args.feature):
+                print('%s\t%s\t%s/%s\t%s'%(peak.manager,peak.feature,peak.inuse,peak.issued,formattime(peak.polled)))
+        elif args.command=='denials':
+            for denial in store.denial_windows(args.start,args.end,args.manager,args.feature):
+                print('%s\t%s\t%s\t%s\t%s polls'%(denial.manager,denial.feature,formattime(denial.start),
+                                                 formattime(denial.end),denial.polls))
+        elif args.command=='usertime':
+            for row in store.user_time(args.start,args.end,args.manager,args.feature,args.user,args.max_gap):
+                print('%s\t%s\t%s\t%.1fh'%(row.userid,row.manager,row.feature,row.seconds/3600.0))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        fake_lmstat
+# Purpose:     Write synthetic "lmutil lmstat -a" output for testing and benchmarking
+#
+# Author:      Luke
+#
+# Created:     21/05/2014
+# Copyright:   (c) 2014
+# Licence:     MIT
+#-------------------------------------------------------------------------------
+#!/usr/bin/env python
+'''
+Usage: fake_lmstat.py [--features N] [--users N] [--seed N] [lmstat -a -c port@server]
+
+Writes lmstat -a style output for N features with N checked out users spread across
+them to stdout. The output is deterministic for a given seed so it can be used as a
+fixture, e.g.
+
+    python fake_lmstat.py --features 2000 --users 50000 > lmstat_large.txt
+
+Any lmutil style arguments are accepted (and the port@server echoed in the header)
+so it can stand in for lmutil in tests. Servers whose name starts with "down" fail
+the way lmutil does when the license server isn't running.
+'''
+import sys,random,argparse
+
+DAYS=('Mon','Tue','Wed','Thu','Fri','Sat','Sun')
+
+def header(license='27000@licenseserver'):
+    port,server=(license.split('@')+['licenseserver'])[:2]
+    return ['lmutil - Copyright (c) 1989-2012 Flexera Software LLC. All Rights Reserved.',
+            'Flexible License Manager status on Mon 3/4/2013 10:00',
+            '',
+            'License server status: %s'%license,
+            '    License file(s) on %s: C:\\Program Files\\ArcGIS\\License10.1\\bin\\service.txt:'%server,
+            '',
+            '%s: license server UP (MASTER) v11.10'%server,
+            '',
+            'Vendor daemon status (on %s):'%server,
+            '',
+            '     ARCGIS: UP v11.10',
+            '',
+            'Feature usage info:',
+            '']
+
+def lmstat(features=2000,users=50000,seed=0,license='27000@licenseserver'):
+    '''Yield synthetic lmstat -a output line by line'''
+    rand=random.Random(seed)
+    server=license.split('@')[-1]
+
+    #Spread users over features unevenly, like real life (a few features have most of the users)
+    weights=[rand.paretovariate(1.2) for i in range(features)]
+    total=sum(weights)
+    counts=[int(users*w/total) for w in weights]
+    for i in range(users-sum(counts)):counts[i%features]+=1
+
+    for line in header(license):yield line
+    for i,inuse in enumerate(counts):
+        feature='FEATURE_%05d'%i
+        issued=inuse+rand.randint(0,10)
+        if i%500==499:  #the odd broken feature
+            yield 'Users of %s:  (Error: %s licenses, unsupported by licensed server)'%(feature,issued)
+            yield ''
+            continue
+        yield 'Users of %s:  (Total of %s license%s issued;  Total of %s license%s in use)'%(
+               feature,issued,'s'*(issued!=1),inuse,'s'*(inuse!=1))
+        yield ''
+        if not inuse:continue
+        yield '  "%s" v10.1, vendor: ARCGIS'%feature
+        yield '  floating license'
+        yield ''
+        for j in range(inuse):
+            user=rand.randint(0,users)
+            yield '    user%05d PC%05d PC%05d (v10.1) (%s/27000 %s), start %s %s/%s %s:%02d'%(
+                   user,user,user,server,rand.randint(100,9999),rand.choice(DAYS),
+                   rand.randint(1,12),rand.randint(1,28),rand.randint(0,23),rand.randint(0,59))
+        yield ''
+
+def main(args=None):
+    parser=argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('--features',type=int,default=2000)
+    parser.add_argument('--users',type=int,default=50000)
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('-c',dest='license',default='27000@licenseserver')
+    args,lmutil=parser.parse_known_args(args)
+
+    if args.license.split('@')[-1].startswith('down'):
+        sys.stdout.write('lmutil - Copyright (c) 1989-2012 Flexera Software LLC. All Rights Reserved.\n'
+                         'Error getting status: Cannot connect to license server system. (-15,10:10061 "WinSock: Connection refused")\n')
+        sys.exit(1)
+
+    write=sys.stdout.write
+    for line in lmstat(args.features,args.users,args.seed,args.license):
+        write(line+'\n')
+
+if __name__ == '__main__':
+    main()
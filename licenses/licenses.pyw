@@ -10,21 +10,47 @@
 # Licence:     MIT
 #-------------------------------------------------------------------------------
 #!/usr/bin/env python
-import os,sys,re,subprocess,json
-from collections import OrderedDict
+import os,sys,json,threading,time,bisect
+from collections import OrderedDict, deque
 from datetime import datetime
 
-#PyQt4/PySide compat
+from lmstat import query
+
+def compiled_ui(uifile, instance):
+    '''Set up instance from the module build_ui.py compiled uifile to, like uic.loadUi does.
+       Returns None if there isn't one or it's older than uifile so the .ui gets parsed instead'''
+    if os.environ.get('LICENSES_RUNTIME_UI'):return None
+    name=os.path.splitext(os.path.basename(uifile))[0]+'_ui'
+    pyfile=os.path.join(os.path.dirname(os.path.abspath(uifile)),name+'.py')
+    try:
+        if os.path.getmtime(pyfile)<os.path.getmtime(uifile):return None
+        module=__import__(name)
+    except (OSError,ImportError):return None
+
+    ui=[getattr(module,c) for c in dir(module) if c.startswith('Ui_')][0]()
+    ui.setupUi(instance)
+    for attr,widget in vars(ui).items():setattr(instance,attr,widget)
+    return instance
+
+#PyQt4/PySide compat, the ui loaders are only imported if there's no compiled ui as they're slow to import
 try:
-    from PyQt4 import QtCore, QtGui, uic
+    from PyQt4 import QtCore, QtGui
     QtCore.Signal = QtCore.pyqtSignal
     QtCore.Slot = QtCore.pyqtSlot
     def uiloader(uifile, instance):
-        return uic.loadUi(uifile, instance)
+        ui=compiled_ui(uifile, instance)
+        if ui is None:
+            from PyQt4 import uic
+            ui=uic.loadUi(uifile, instance)
+        return ui
 except:
-    from PySide import QtCore, QtGui, QtUiTools
+    from PySide import QtCore, QtGui
     def uiloader(uifile, instance):
-        return QtUiTools.QUiLoader().load(uifile, instance)
+        ui=compiled_ui(uifile, instance)
+        if ui is None:
+            from PySide import QtUiTools
+            ui=QtUiTools.QUiLoader().load(uifile, instance)
+        return ui
 
 try:import licenses_qrc
 except:pass
@@ -162,7 +188,9 @@ class MainWindow(QtGui.QMainWindow):
         QtGui.QMainWindow.__init__(self)
 
         self.userinfo=UserInfo()
-        self.username=self.userinfo.username
+        self.resolver=UsernameResolver(self.userinfo)
+        self.resolver.resolved.connect(self.onUsernameResolved)
+        self.nameitems={}  #{userid:[name QTableWidgetItems waiting on the resolver]}
 
         self.loading=False
         self.selected=None
@@ -200,15 +228,29 @@ class MainWindow(QtGui.QMainWindow):
         except AttributeError: #pyside
             default_blacklist=json.loads(str(default_settings.value('blacklist')))
         except:default_blacklist=[]
+        #Auto refresh interval in seconds, 0 to turn it off
+        try: #pyqt4
+            default_refresh=default_settings.value('refresh').toPyObject()
+        except AttributeError: #pyside
+            default_refresh=default_settings.value('refresh')
+        try:default_refresh=int(str(default_refresh))
+        except ValueError:default_refresh=0
+        #Database written by collector.py to read from instead of running lmutil
+        try: #pyqt4
+            default_database=default_settings.value('database').toPyObject()
+        except AttributeError: #pyside
+            default_database=default_settings.value('database')
+        default_database=str(default_database or '')
 
         #User settings
         self.settings=QtCore.QSettings( QtCore.QSettings.IniFormat,
                                         QtCore.QSettings.UserScope,
                                         "License Checker")
 
-        self.dlgSettings = SettingsDialog(self, {'managers':default_managers,
-                                                 'lookup':default_lookup,
-                                                 'blacklist':default_blacklist})
+        self.defaults={'managers':default_managers,
+                       'lookup':default_lookup,
+                       'blacklist':default_blacklist}
+        self._dlgSettings=None
 
         try:self.managers=json.loads(str(self.settings.value('managers').toPyObject()))
         except:self.managers=default_managers
@@ -216,6 +258,16 @@ class MainWindow(QtGui.QMainWindow):
         except:self.lookup=default_lookup
         try:self.blacklist=json.loads(str(self.settings.value('blacklist').toPyObject()))
         except:self.blacklist=default_blacklist
+        try:self.refresh=int(str(self.settings.value('refresh').toPyObject()))
+        except:self.refresh=default_refresh
+        try:self.database=str(self.settings.value('database').toPyObject() or default_database)
+        except:self.database=default_database
+
+    def dlgSettings(self):
+        #Rarely opened, so don't slow down startup building it until it is.
+        #Not a property, connectSlotsByName would evaluate it looking for slots
+        if self._dlgSettings is None:self._dlgSettings=SettingsDialog(self, self.defaults)
+        return self._dlgSettings
 
     def init_ui(self):
         #self.ui = uic.loadUi(__file__.replace('.pyw','.ui'), self)
@@ -230,18 +282,35 @@ class MainWindow(QtGui.QMainWindow):
         rect=self.gif.frameRect()
         self.ui.loadingLabel.resize(rect.width(), rect.height())
 
-        self.ui.treeWidget.resizeEvent=self.override_resizeEvent(self.ui.treeWidget)
+        self.model=LicenseModel(self.lookup,self.blacklist,self)
+        self.ui.treeView.setModel(self.model)
+        self.ui.treeView.selectionModel().currentChanged.connect(self.onCurrentChanged)
+        self.model.dataChanged.connect(self.onModelDataChanged)
+
+        self.ui.treeView.resizeEvent=self.override_resizeEvent(self.ui.treeView)
 
-    def loadLicenseInfo(self):
+        self.refreshTimer=QtCore.QTimer(self)
+        self.refreshTimer.timeout.connect(self.autoRefresh)
+        if self.refresh>0:self.refreshTimer.start(self.refresh*1000)
+
+    def autoRefresh(self):
+        #Nobody's looking, don't bother the license servers
+        if not self.isMinimized():self.loadLicenseInfo(quiet=True)
+
+    def loadLicenseInfo(self,quiet=False):
+        '''Poll the license managers, the tree is updated in place as results come in
+           so quiet refreshes don't need the loading animation'''
         if self.loading:return
-        self.showLoading()
-        self.ui.treeWidget.clear()
-        self.ui.userTableWidget.setRowCount(0)
+        if quiet:self.loading=True
+        else:self.showLoading()
         self.Thread = QtCore.QThread()
-        self.LicenseInfo=LicenseInfo(self.managers)
+        if self.database:self.LicenseInfo=StoredLicenseInfo(self.managers,self.database)
+        else:self.LicenseInfo=LicenseInfo(self.managers)
         self.LicenseInfo.moveToThread(self.Thread)
         self.LicenseInfo.finished.connect(self.onLicenseInfoFinished)
+        self.LicenseInfo.feature.connect(self.onLicenseInfoFeature)
         self.LicenseInfo.featureinfo.connect(self.onLicenseInfoFeatures)
+        self.LicenseInfo.error.connect(self.onLicenseInfoError)
         self.Thread.started.connect(self.LicenseInfo.get)
         self.Thread.start()
 
@@ -254,7 +323,8 @@ class MainWindow(QtGui.QMainWindow):
         self.ui.actionSettings.setEnabled(False)
 
     def hideLoading(self):
-        self.Thread.terminate()
+        self.Thread.quit()
+        self.Thread.wait()
         self.ui.loadingLabel.hide()
         self.gif.stop()
         self.ui.actionRefresh.setEnabled(True)
@@ -262,30 +332,28 @@ class MainWindow(QtGui.QMainWindow):
         self.loading=False
 
     def onLicenseInfoFinished(self):
+        self.model.prune([m for s,p,m in self.managers])
         self.hideLoading()
-        self.ui.treeWidget.resizeColumnToContents(0)
+        self.ui.treeView.resizeColumnToContents(0)
 
-    def onLicenseInfoFeatures(self,manager,featureinfo):
+    def onLicenseInfoError(self,manager,message):
+        self.model.setError(manager,message)
+
+    def closeEvent(self,event):
+        if self.loading:self.LicenseInfo.cancel()
+        QtGui.QMainWindow.closeEvent(self,event)
+
+    def onLicenseInfoFeature(self,manager,feature,info):
+        if feature in self.blacklist:return
 
-        item=QtGui.QTreeWidgetItem(self.ui.treeWidget)
-        item.setText(0,manager)
-
-        self.ui.treeWidget.addTopLevelItem(item)
-        featureinfo=dict([(self.lookup.get(f,f),i)
-                           for f,i in featureinfo.items()
-                           if f not in self.blacklist])
-
-        for feature,info in sorted(featureinfo.items()):
-            feature = self.lookup.get(feature,feature)
-            child=QtGui.QTreeWidgetItem(item)
-            child.setText(0,feature)
-            child.setText(1,info['available'].rjust(2))
-            child.setText(2,info['issued'].rjust(2))
-            child.setText(3,info['inuse'].rjust(2))
-            child.setData(0,QtCore.Qt.UserRole,(manager,feature,info,)) #wrap dict in tuple so it doesn't get converted to QT C++ type
-            child.setTextAlignment(1, QtCore.Qt.AlignHCenter)
-            child.setTextAlignment(2, QtCore.Qt.AlignHCenter)
-            child.setTextAlignment(3, QtCore.Qt.AlignHCenter)
+        #Look up everyone's name in the background so they're ready when the feature is selected
+        self.resolver.prefetch([u[0] for u in info['users']])
+
+        self.model.setFeature(manager,feature,info)
+
+    def onLicenseInfoFeatures(self,manager,featureinfo):
+        #Features have already been added/updated as they were parsed, this drops any that have gone
+        self.model.setFeatures(manager,featureinfo)
 
     #Autoconnected event handlers
     def on_actionExit_triggered(self,checked=None):
@@ -297,11 +365,12 @@ class MainWindow(QtGui.QMainWindow):
 
         from urllib import quote
         import webbrowser
-        for item in self.ui.treeWidget.selectedItems():
-            data = item.data(0,QtCore.Qt.UserRole).toPyObject()
-            manager = data[0]
-            feature = data[1]
-            info = data[2]
+        for index in self.ui.treeView.selectedIndexes():
+            node = self.model.node(index)
+            if node.feature is None:continue
+            manager = node.parent.name
+            feature = node.name
+            info = node.info
             userids=[u[0] for u in info['users']]
             webbrowser.open_new('mailto:%s?subject=%s %s licence?'%(';'.join(userids),manager,feature))
             break
@@ -313,7 +382,7 @@ class MainWindow(QtGui.QMainWindow):
     def on_actionSettings_triggered(self,checked=None):
         if checked is None: return
 
-        dlg = self.dlgSettings
+        dlg = self.dlgSettings()
         dlg.set_values({'managers':self.managers,
                         'lookup':OrderedDict(self.lookup),
                         'blacklist':self.blacklist})
@@ -326,52 +395,77 @@ class MainWindow(QtGui.QMainWindow):
             self.settings.setValue('managers',json.dumps(self.managers))
             self.settings.setValue('lookup',json.dumps(self.lookup))
             self.settings.setValue('blacklist',json.dumps(self.blacklist))
+            self.model.setFilters(self.lookup,self.blacklist)
 
-    def on_treeWidget_currentItemChanged(self, item, *args,**kwargs):
-        if item is None:return
+    def onCurrentChanged(self, current, previous):
+        if not current.isValid():return
 
-        if item.childCount() > 0: #Top level
-            item.setExpanded (not item.isExpanded())
+        node=self.model.node(current)
+        if node.feature is None: #Top level
+            index=current.sibling(current.row(),0)
+            if node.children:self.ui.treeView.setExpanded(index,not self.ui.treeView.isExpanded(index))
         else:#Child
-            data = item.data(0,QtCore.Qt.UserRole).toPyObject()
-            manager = data[0]
-            feature = data[1]
-            info = data[2]
-            self.ui.userTableWidget.setRowCount(len(info['users']))
-
-            now = datetime.now()
-            year=now.year
-
-            for i,user in enumerate(info['users']):
-                #[userid,computer,startdate]
-                username=self.username(user[0])
-                self.userTableWidget.setItem(i, 0, QtGui.QTableWidgetItem(username))
-                self.userTableWidget.setItem(i, 1, QtGui.QTableWidgetItem(user[0].upper()))
-                self.userTableWidget.setItem(i, 2, QtGui.QTableWidgetItem(user[1]))
-                dt=datetime.strptime(user[2],'%a %m/%d %H:%M')
-                dt=dt.replace(year=year)   #defaults to 1900, set it to current year
-                if (now - dt).days < 0: #Was it last year instead?
-                    dt=dt.replace(year=year-1)
-                self.userTableWidget.setItem(i, 3, DateTableWidgetItem(dt, '%a %d/%m %H:%M'))
-
-            self.ui.userTableWidget.resizeColumnToContents(2)
-            self.ui.userTableWidget.resizeColumnToContents(1)
-            self.ui.userTableWidget.resizeColumnToContents(0)
-
-            if int(info['available'])==0:
-                self.ui.actionMailto.setEnabled(True)
-            else:
-                self.ui.actionMailto.setEnabled(False)
+            self.showUsers(node)
+
+    def onModelDataChanged(self, topLeft, bottomRight):
+        #Refresh the user table if the selected feature's users changed
+        current=self.ui.treeView.currentIndex()
+        if (current.isValid() and current.parent()==topLeft.parent()
+            and topLeft.row()<=current.row()<=bottomRight.row()):
+            node=self.model.node(current)
+            if node.feature is not None:self.showUsers(node)
+
+    def showUsers(self, node):
+        info = node.info
+        self.nameitems={}
+        self.ui.userTableWidget.setSortingEnabled(False) #otherwise rows move while they're being filled
+        self.ui.userTableWidget.setRowCount(len(info['users']))
+        self.resolver.prefetch([u[0] for u in info['users']],urgent=True)
+
+        now = datetime.now()
+        year=now.year
+
+        for i,user in enumerate(info['users']):
+            #[userid,computer,startdate]
+            username=self.resolver.cached(user[0])
+            nameitem=QtGui.QTableWidgetItem(username or '')
+            if username is None:self.nameitems.setdefault(user[0],[]).append(nameitem)
+            self.userTableWidget.setItem(i, 0, nameitem)
+            self.userTableWidget.setItem(i, 1, QtGui.QTableWidgetItem(user[0].upper()))
+            self.userTableWidget.setItem(i, 2, QtGui.QTableWidgetItem(user[1]))
+            dt=datetime.strptime(user[2],'%a %m/%d %H:%M')
+            dt=dt.replace(year=year)   #defaults to 1900, set it to current year
+            if (now - dt).days < 0: #Was it last year instead?
+                dt=dt.replace(year=year-1)
+            self.userTableWidget.setItem(i, 3, DateTableWidgetItem(dt, '%a %d/%m %H:%M'))
+
+        self.ui.userTableWidget.setSortingEnabled(True)
+        self.ui.userTableWidget.resizeColumnToContents(2)
+        self.ui.userTableWidget.resizeColumnToContents(1)
+        self.ui.userTableWidget.resizeColumnToContents(0)
+
+        if int(info['available'])==0:
+            self.ui.actionMailto.setEnabled(True)
+        else:
+            self.ui.actionMailto.setEnabled(False)
 
-    def on_treeWidget_itemExpanded(self,item,*args,**kwargs):
-        self.ui.userTableWidget.setRowCount(0)
-        self.ui.treeWidget.resizeColumnToContents(0)
+    def on_treeView_expanded(self,index,*args,**kwargs):
+        self.clearUsers()
+        self.ui.treeView.resizeColumnToContents(0)
 
-    def on_treeWidget_itemCollapsed(self,item,*args,**kwargs):
-        for item in self.ui.treeWidget.selectedItems():
-            item.setSelected(False)
+    def on_treeView_collapsed(self,index,*args,**kwargs):
+        self.ui.treeView.clearSelection()
+        self.clearUsers()
+
+    def clearUsers(self):
+        self.nameitems={}
         self.ui.userTableWidget.setRowCount(0)
 
+    def onUsernameResolved(self,userid,username):
+        items=self.nameitems.pop(userid,[])
+        for item in items:item.setText(username)
+        if items and not self.nameitems:self.ui.userTableWidget.resizeColumnToContents(0)
+
     def override_resizeEvent(self,widget):
         def func(event):
             width = event.size().width()
@@ -384,6 +478,188 @@ class MainWindow(QtGui.QMainWindow):
             for i in fixcols:widget.setColumnWidth(i, fixed)
         return func
 
+class LicenseNode(object):
+    '''A license manager (feature is None) or one of its features in a LicenseModel'''
+    def __init__(self,name,parent=None,feature=None,info=None):
+        self.name=name          #manager name or feature display (lookup) name
+        self.parent=parent
+        self.feature=feature    #feature name as lmstat reports it
+        self.info=info
+        self.error=None
+        self.featureinfo=None   #last complete lmstat result for a manager
+        self.children=[]
+        self.keys=[]            #sort keys of the children, kept in step for bisect
+
+    def row(self):
+        return self.parent.children.index(self)
+
+class LicenseModel(QtCore.QAbstractItemModel):
+    '''License managers and their features, sorted by display name.
+
+       Results are merged into the existing rows so a refresh only inserts, removes or
+       changes the rows that are actually different, which keeps the selection and
+       expanded state and doesn't flicker.
+    '''
+    headers=('Licenses','Available','Total','In use')
+    columns=(None,'available','issued','inuse')
+
+    def __init__(self,lookup=None,blacklist=(),parent=None):
+        QtCore.QAbstractItemModel.__init__(self,parent)
+        self.root=LicenseNode(None)
+        self.lookup=dict(lookup or {})
+        self.blacklist=set(blacklist)
+
+    def node(self,index):
+        if index.isValid():return index.internalPointer()
+        return self.root
+
+    def index(self,row,column,parent=QtCore.QModelIndex()):
+        node=self.node(parent)
+        if 0<=row<len(node.children) and 0<=column<len(self.headers):
+            return self.createIndex(row,column,node.children[row])
+        return QtCore.QModelIndex()
+
+    def parent(self,index):
+        if not index.isValid():return QtCore.QModelIndex()
+        node=index.internalPointer().parent
+        if node is self.root:return QtCore.QModelIndex()
+        return self.createIndex(node.row(),0,node)
+
+    def rowCount(self,parent=QtCore.QModelIndex()):
+        if parent.column()>0:return 0
+        return len(self.node(parent).children)
+
+    def columnCount(self,parent=QtCore.QModelIndex()):
+        return len(self.headers)
+
+    def headerData(self,section,orientation,role=QtCore.Qt.DisplayRole):
+        if orientation==QtCore.Qt.Horizontal:
+            if role==QtCore.Qt.DisplayRole:return self.headers[section]
+            if role==QtCore.Qt.TextAlignmentRole and section>0:return QtCore.Qt.AlignHCenter
+        return None
+
+    def data(self,index,role=QtCore.Qt.DisplayRole):
+        if not index.isValid():return None
+        node=index.internalPointer()
+        column=index.column()
+
+        if role==QtCore.Qt.DisplayRole:
+            if node.feature is not None:
+                if column==0:return node.name
+                return node.info[self.columns[column]].rjust(2)
+            elif column==0:
+                if node.error:return '%s (%s)'%(node.name,node.error)
+                return node.name
+        elif role==QtCore.Qt.TextAlignmentRole and column>0:
+            return QtCore.Qt.AlignHCenter
+        elif node.error and role==QtCore.Qt.ToolTipRole:
+            return node.error
+        elif node.error and role==QtCore.Qt.ForegroundRole:
+            return QtGui.QBrush(QtCore.Qt.red)
+        return None
+
+    def key(self,feature):
+        return (self.lookup.get(feature,feature),feature)
+
+    def managerNode(self,manager):
+        for node in self.root.children:
+            if node.name==manager:return node
+
+        row=len(self.root.children)
+        self.beginInsertRows(QtCore.QModelIndex(),row,row)
+        node=LicenseNode(manager,self.root)
+        self.root.children.append(node)
+        self.endInsertRows()
+        return node
+
+    def setFeature(self,manager,feature,info):
+        '''Add or update a single feature, i.e. as soon as it has been parsed'''
+        if feature in self.blacklist:return
+
+        parent=self.managerNode(manager)
+        key=self.key(feature)
+        row=bisect.bisect_left(parent.keys,key)
+        if row<len(parent.keys) and parent.keys[row]==key:
+            self.changeRow(parent,row,info)
+        else:
+            self.beginInsertRows(self.createIndex(parent.row(),0,parent),row,row)
+            parent.keys.insert(row,key)
+            parent.children.insert(row,LicenseNode(key[0],parent,feature,info))
+            self.endInsertRows()
+
+    def setFeatures(self,manager,featureinfo):
+        '''Replace all of a manager's features'''
+        parent=self.managerNode(manager)
+        parent.featureinfo=featureinfo
+        self.merge(parent)
+        self.setErrorText(parent,None)
+
+    def setError(self,manager,message):
+        '''Flag a manager that couldn't be polled, its old features would be stale so drop them'''
+        parent=self.managerNode(manager)
+        parent.featureinfo=None
+        self.merge(parent)
+        self.setErrorText(parent,message)
+
+    def setFilters(self,lookup,blacklist):
+        '''Change the feature lookup/blacklist, reusing the last results for each manager'''
+        self.lookup=dict(lookup)
+        self.blacklist=set(blacklist)
+        for parent in self.root.children:
+            self.merge(parent)
+
+    def prune(self,managers):
+        '''Remove any managers not in managers, e.g. after they've been removed in the settings'''
+        for row in reversed(range(len(self.root.children))):
+            if self.root.children[row].name not in managers:
+                self.beginRemoveRows(QtCore.QModelIndex(),row,row)
+                del self.root.children[row]
+                self.endRemoveRows()
+
+    def merge(self,parent):
+        '''Diff parent's children against its featureinfo, both sorted by key, emitting the minimum
+           insert/remove (a run of rows at a time) and dataChanged signals to bring them into line'''
+        featureinfo=parent.featureinfo or {}
+        new=sorted(((self.key(f),f,i) for f,i in featureinfo.items() if f not in self.blacklist),
+                   key=lambda row:row[0])
+        keys=parent.keys
+        index=self.createIndex(parent.row(),0,parent)
+
+        i=j=0
+        while i<len(keys) or j<len(new):
+            if j==len(new) or (i<len(keys) and keys[i]<new[j][0]):
+                stop=i+1
+                while stop<len(keys) and (j==len(new) or keys[stop]<new[j][0]):stop+=1
+                self.beginRemoveRows(index,i,stop-1)
+                del keys[i:stop],parent.children[i:stop]
+                self.endRemoveRows()
+            elif i==len(keys) or new[j][0]<keys[i]:
+                stop=j+1
+                while stop<len(new) and (i==len(keys) or new[stop][0]<keys[i]):stop+=1
+                self.beginInsertRows(index,i,i+stop-j-1)
+                keys[i:i]=[k for k,f,info in new[j:stop]]
+                parent.children[i:i]=[LicenseNode(k[0],parent,f,info) for k,f,info in new[j:stop]]
+                self.endInsertRows()
+                i+=stop-j
+                j=stop
+            else:
+                self.changeRow(parent,i,new[j][2])
+                i+=1
+                j+=1
+
+    def changeRow(self,parent,row,info):
+        node=parent.children[row]
+        if node.info!=info:
+            node.info=info
+            self.dataChanged.emit(self.createIndex(row,0,node),
+                                  self.createIndex(row,len(self.headers)-1,node))
+
+    def setErrorText(self,node,message):
+        if node.error!=message:
+            node.error=message
+            index=self.createIndex(node.row(),0,node)
+            self.dataChanged.emit(index,index)
+
 class DateTableWidgetItem(QtGui.QTableWidgetItem):
     '''Convert string to date so we can sort'''
     def __init__(self, date_time, fmt=QtCore.Qt.TextDate):
@@ -402,61 +678,180 @@ class DateTableWidgetItem(QtGui.QTableWidgetItem):
             return QtGui.QTableWidgetItem.__lt__(self,other)
 
 class LicenseInfo(QtCore.QObject):
+    '''Poll all license managers at once, emitting feature as each feature is parsed
+       and featureinfo (or error) as each manager finishes'''
 
     finished = QtCore.Signal()
+    feature = QtCore.Signal(str,str,dict)
     featureinfo = QtCore.Signal(str,dict)
+    error = QtCore.Signal(str,str)
 
-    def __init__(self,managers):
+    def __init__(self,managers,timeout=30):
         QtCore.QObject.__init__(self)
 
         self.managers=managers
+        self.timeout=timeout  #seconds per manager
+        self.procs=[]         #running lmutil processes, see cancel
+        self.cancelled=False
+
+    #@QtCore.Slot()
+    def get(self):
+        threads=[threading.Thread(target=self.poll,args=(server,port,manager))
+                 for server,port,manager in self.managers]
+        for thread in threads:
+            thread.daemon=True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.finished.emit()
+
+    def cancel(self):
+        self.cancelled=True
+        for proc in self.procs[:]:
+            try:proc.kill()
+            except OSError:pass
+
+    def poll(self,server,port,manager):
+        def onfeature(feature,info):
+            if not self.cancelled:self.feature.emit(manager,feature,info)
+
+        featureinfo,error=query(server,port,self.timeout,self.procs,onfeature=onfeature)
+        if self.cancelled:return
+        if error:self.error.emit(manager,error)
+        else:self.featureinfo.emit(manager,featureinfo)
+
+class TTLCache(object):
+    '''Thread safe LRU cache whose entries expire ttl seconds after they are set'''
+    def __init__(self,maxsize=5000):
+        self.maxsize=maxsize
+        self.data=OrderedDict()
+        self.lock=threading.Lock()
+
+    def get(self,key,default=None):
+        with self.lock:
+            try:value,expires=self.data.pop(key)
+            except KeyError:return default
+            if expires<time.time():return default
+            self.data[key]=(value,expires) #move to the end, i.e. most recently used
+            return value
+
+    def set(self,key,value,ttl):
+        with self.lock:
+            self.data.pop(key,None)
+            self.data[key]=(value,time.time()+ttl)
+            while len(self.data)>self.maxsize:self.data.popitem(last=False)
+
+class UsernameResolver(QtCore.QObject):
+    '''Look up display names for userids in a background thread and cache them,
+       including userids that aren't found so we don't keep asking the directory'''
+
+    resolved = QtCore.Signal(str,str)
+
+    def __init__(self,userinfo,ttl=3600,negative_ttl=300,maxsize=5000):
+        QtCore.QObject.__init__(self)
+
+        self.userinfo=userinfo
+        self.ttl=ttl                    #seconds to keep names
+        self.negative_ttl=negative_ttl  #seconds to remember userids that weren't found
+        self.cache=TTLCache(maxsize)
+        self.todo=deque()
+        self.pending=set()
+        self.condition=threading.Condition()
+
+        self.thread=threading.Thread(target=self.run)
+        self.thread.daemon=True
+        self.thread.start()
+
+    def cached(self,userid):
+        '''Cached name for userid, '' if it wasn't found or None if it hasn't been looked up yet'''
+        return self.cache.get(userid)
+
+    def prefetch(self,userids,urgent=False):
+        '''Queue userids to be looked up, urgent ones (i.e. on screen now) go to the front'''
+        with self.condition:
+            userids=[u for u in OrderedDict.fromkeys(userids)
+                     if (urgent or u not in self.pending) and self.cache.get(u) is None]
+            if not userids:return
+            self.pending.update(userids)
+            if urgent:self.todo.extendleft(reversed(userids))
+            else:self.todo.extend(userids)
+            self.condition.notify()
+
+    def run(self):
+        try:
+            import pythoncom #COM has to be initialised in each thread that uses it
+            pythoncom.CoInitialize()
+        except ImportError:pass
+
+        while True:
+            with self.condition:
+                while not self.todo:self.condition.wait()
+                #Take everything that's queued so UserInfo can look it up in bulk
+                userids=[u for u in OrderedDict.fromkeys(self.todo) if self.cache.get(u) is None]
+                self.todo.clear()
+            if not userids:continue
+
+            try:
+                for userid,username in self.userinfo.usernames(userids):
+                    self.cache.set(userid,username,self.ttl if username else self.negative_ttl)
+                    with self.condition:self.pending.discard(userid)
+                    self.resolved.emit(userid,username)
+            except Exception:
+                with self.condition:self.pending.difference_update(userids)
+
+class StoredLicenseInfo(QtCore.QObject):
+    '''Same signals as LicenseInfo, but reads the latest results saved by collector.py
+       instead of running lmutil, so clients don't add any load to the license servers'''
+
+    finished = QtCore.Signal()
+    feature = QtCore.Signal(str,str,dict)
+    featureinfo = QtCore.Signal(str,dict)
+    error = QtCore.Signal(str,str)
+
+    def __init__(self,managers,database):
+        QtCore.QObject.__init__(self)
 
-        self.featpat = re.compile(
-            (r'Users of (?P<feature>.*):.*'
-             r'Total of (?P<issued>\d+) license[s]* issued.*'
-             r'Total of (?P<inuse>\d+) license[s]* in use.*$'), re.IGNORECASE)
-        self.userpat = re.compile(
-            (r'^(?P<userid>\S+)\s(?P<computer>\S+)\s.*'
-             r'start (?P<date>.*)$'), re.IGNORECASE)
+        self.managers=managers
+        self.database=database
 
     #@QtCore.Slot()
     def get(self):
-        cmd=['lmutil','lmstat','-a','-c']
-        for server,port, manager in self.managers:
-            exit_code, stdout, stderr = runcmd(cmd+['%s@%s'%(port,server)])
-            stdout=stdout[stdout.find('Users of'):]
-            featureinfo = OrderedDict()
-            for line in stdout.splitlines():
-                line=line.strip()
-                if line.startswith('Users of'):
-                    r = self.featpat.search(line)
-                    if r:
-                        d = r.groupdict()
-                        issued=d['issued']
-                        inuse = d['inuse']
-                        available = str(int(issued) - int(inuse))
-                        feature=d['feature']
-                        featureinfo[feature]={'issued':issued,
-                                           'inuse':inuse,
-                                           'available':available,
-                                           'users':[]
-                                           }
-                elif line:
-                    r = self.userpat.search(line)
-                    if r:
-                        d = r.groupdict()
-                        userid=d['userid']
-                        computer = d['computer']
-                        startdate=d['date']
-                        featureinfo[feature]['users'].append([userid,computer,startdate])
-
-            self.featureinfo.emit(manager,featureinfo)
+        from collector import LicenseStore #sqlite connections have to be made in the thread that uses them
+        try:
+            store=LicenseStore(self.database,create=False)
+            for server,port,manager in self.managers:
+                latest=store.latest(manager)
+                if latest is None:
+                    self.error.emit(manager,'not collected yet')
+                    continue
+                polled,featureinfo,error=latest
+                if error:
+                    self.error.emit(manager,error)
+                    continue
+                for feature,info in featureinfo.items():self.feature.emit(manager,feature,info)
+                self.featureinfo.emit(manager,featureinfo)
+            store.close()
+        except Exception as err:
+            for server,port,manager in self.managers:self.error.emit(manager,str(err))
 
         self.finished.emit()
 
+    def cancel(self):
+        pass
+
 class UserInfo(object):
     def __init__(self):
+        self._parent=None
         if os.name=='nt':
+            self.username=self._winusername
+        else:
+            self.username=self._nixusername
+
+    def _adparent(self):
+        '''The AD container users live in, looked up on first use (i.e. in the background
+           resolver thread) as importing win32com and binding to AD is slow'''
+        if self._parent is None:
             try:
                 import win32com.client #raises an error if pythonwin not installed...
                 objADSystemInfo = win32com.client.Dispatch("ADSystemInfo")
@@ -466,17 +861,30 @@ class UserInfo(object):
                 pathname='LDAP://'+objADSystemInfo.UserName
                 objADSPathname.Set(pathname,ADS_SETTYPE_FULL)
                 self._parent=objADSPathname.Retrieve(8)
-                self.username=self._winusername
             except:
-                self.username=self._nousername
+                self._parent=False
+        return self._parent
+
+    def usernames(self,userids):
+        '''Yield (userid, username) for each userid, username is '' if it wasn't found'''
+        if self.username==self._nixusername:
+            import pwd
+            gecos=dict((p.pw_name,p.pw_gecos) for p in pwd.getpwall())
+            for user in userids:
+                for u in (user,user.upper(), user.lower()):
+                    if u in gecos:
+                        yield user,gecos[u]
+                        break
+                else:yield user,self._nixusername(user) #getpwall doesn't always list directory (LDAP/NIS) users
         else:
-            self.username=self._nixusername
+            for user in userids:yield user,self.username(user)
 
     def _nousername(self,*args):
         return 'Pythonwin is not installed!'
 
     def _winusername(self,user):
-        import win32com.client #raises an error if pythonwin not installed...
+        if not self._adparent():return self._nousername()
+        import win32com.client
         try:
             pathname='LDAP://CN=%s,%s'%(user,self._parent)
             username = win32com.client.GetObject(pathname).displayName
@@ -490,19 +898,6 @@ class UserInfo(object):
             except KeyError:continue
         return ''
 
-def runcmd(cmd):
-    if os.name=='nt':
-        startupinfo=subprocess.STARTUPINFO()#Windows starts up a console when a subprocess is run from a non-console
-        startupinfo.dwFlags |= 1            #app like pythonw unless we pass it a flag that says not to...
-    else:startupinfo=None
-    proc=subprocess.Popen(cmd, startupinfo=startupinfo,
-                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                          stdin=subprocess.PIPE)
-    if os.name=='nt':proc.stdin.close()
-    stdout,stderr=proc.communicate()
-    exit_code=proc.wait()
-    return exit_code, stdout, stderr
-
 if __name__ == '__main__':
     app = QtGui.QApplication(sys.argv)
     main = MainWindow()
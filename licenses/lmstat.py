@@ -0,0 +1,135 @@
+# -*- coding: UTF-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        lmstat
+# Purpose:     Run lmutil and parse lmstat output without needing Qt
+#
+# Author:      Luke
+#
+# Created:     21/05/2014
+# Copyright:   (c) 2014
+# Licence:     MIT
+#-------------------------------------------------------------------------------
+#!/usr/bin/env python
+import os,re,subprocess,threading
+from collections import OrderedDict
+
+FEATPAT = re.compile(
+    (r'Users of (?P<feature>.*):.*'
+     r'Total of (?P<issued>\d+) license[s]* issued.*'
+     r'Total of (?P<inuse>\d+) license[s]* in use.*$'), re.IGNORECASE)
+USERPAT = re.compile(
+    (r'^(?P<userid>\S+)\s(?P<computer>\S+)\s.*'
+     r'start (?P<date>.*)$'), re.IGNORECASE)
+
+def parse_lmstat(lines,featpat=FEATPAT,userpat=USERPAT):
+    '''Parse lmstat -a output incrementally, yielding (feature, info) as soon as
+       each "Users of" block is complete. lines can be any iterable of str, e.g. a Command.
+
+       Lines are dispatched on their prefix first so only "Users of" lines see featpat
+       and only lines inside a feature block that look like a checkout see userpat.
+       With the default userpat, ordinary space separated checkout lines are split
+       directly instead, which gives the same result at about twice the speed.
+    '''
+    fast=userpat is USERPAT
+    feature=info=None
+    for line in lines:
+        line=line.strip()
+        if not line:continue
+        if line.startswith('Users of'):
+            if feature is not None:yield feature,info
+            feature=info=None
+            r = featpat.search(line)
+            if r:  #"Users of FEATURE:  (Error: ...)" lines don't match, skip their block
+                d = r.groupdict()
+                issued=d['issued']
+                inuse = d['inuse']
+                feature=d['feature']
+                info={'issued':issued,
+                      'inuse':inuse,
+                      'available':str(int(issued) - int(inuse)),
+                      'users':[]
+                      }
+        elif feature is None or line[0]=='"' or 'start ' not in line:
+            continue  #header, vendor/version and "floating license" lines
+        else:
+            if fast and '\t' not in line:
+                fields=line.split(' ',2)
+                i=line.rfind('start ')
+                if len(fields)==3 and fields[0] and fields[1] and i>len(fields[0])+len(fields[1])+1:
+                    info['users'].append([fields[0],fields[1],line[i+6:]])
+                    continue
+            r = userpat.search(line)
+            if r:
+                info['users'].append([r.group('userid'),r.group('computer'),r.group('date')])
+
+    if feature is not None:yield feature,info
+
+try:DEVNULL=subprocess.DEVNULL
+except AttributeError:DEVNULL=open(os.devnull,'rb')  #python 2
+
+def _popen(cmd,**kwargs):
+    if os.name=='nt':
+        startupinfo=subprocess.STARTUPINFO()#Windows starts up a console when a subprocess is run from a non-console
+        startupinfo.dwFlags |= 1            #app like pythonw unless we pass it a flag that says not to...
+    else:startupinfo=None
+    proc=subprocess.Popen(cmd, startupinfo=startupinfo,
+                          stdout=subprocess.PIPE, stdin=DEVNULL, **kwargs)
+    return proc
+
+class Command(object):
+    '''Run cmd and iterate over its output (stdout and stderr) line by line as it arrives.
+
+       cmd is killed after timeout seconds, after which iteration stops and timedout is True.
+       The process is added to the procs list (if given) while it runs so it can be killed
+       from elsewhere. exit_code is set once iteration finishes.
+    '''
+    def __init__(self,cmd,timeout=None,procs=None):
+        self.cmd=cmd
+        self.timeout=timeout
+        self.procs=procs
+        self.exit_code=None
+        self.timedout=False
+        self.lastline=''  #last non blank line, handy for error messages
+
+    def kill(self,proc):
+        try:proc.kill()
+        except OSError:pass
+
+    def ontimeout(self,proc):
+        self.timedout=True
+        self.kill(proc)
+
+    def __iter__(self):
+        proc=_popen(self.cmd, stderr=subprocess.STDOUT)
+        if self.procs is not None:self.procs.append(proc)
+        timer=threading.Timer(self.timeout,self.ontimeout,(proc,)) if self.timeout else None
+        if timer:timer.start()
+        try:
+            for line in iter(proc.stdout.readline,b''):
+                if not isinstance(line,str):line=line.decode('utf-8','replace')
+                if line.strip():self.lastline=line.strip()
+                yield line
+            self.exit_code=proc.wait()
+        finally:
+            if timer:timer.cancel()
+            if proc.poll() is None:self.kill(proc)  #iteration abandoned
+            proc.stdout.close()
+            if self.procs is not None:self.procs.remove(proc)
+
+def query(server,port,timeout=None,procs=None,lmutil=('lmutil',),onfeature=None):
+    '''Run lmstat -a against port@server, returning (featureinfo, error) where error is None
+       if it worked. onfeature(feature, info) is called as each feature is parsed.'''
+    cmd=Command(list(lmutil)+['lmstat','-a','-c','%s@%s'%(port,server)],timeout,procs)
+    featureinfo = OrderedDict()
+    try:
+        for feature,info in parse_lmstat(cmd):
+            featureinfo[feature]=info
+            if onfeature:onfeature(feature,info)
+    except Exception as err:  #e.g. lmutil not on the PATH
+        return None,str(err)
+
+    if cmd.timedout:
+        return None,'timed out after %ss'%timeout
+    if cmd.exit_code and not featureinfo:
+        return None,cmd.lastline or 'lmutil exit code %s'%cmd.exit_code
+    return featureinfo,None